@@ -11,27 +11,26 @@ __license__ = "LGPL-3.0-only"
 __disclaimer__ = """USE THIS SCRIPT AT YOUR OWN RISK!
 IT COMES WITHOUT WARRANTY AND IS NOT SUPPORTED BY IXSYSTEMS."""
 
-import argparse
-import configparser
+# Only import modules here which are needed by most commands,
+# other modules are imported where they're used to keep startup fast
 import contextlib
-import hashlib
+import errno
+import fnmatch
+import functools
 import io
-import json
+import math
 import os
-import platform
 import re
-import readline
+import select
 import shlex
-import shutil
+import signal
 import stat
+import struct
 import subprocess
 import sys
-import tempfile
+import threading
 import time
-import urllib.request
-from collections import defaultdict
-from inspect import cleandoc
-from pathlib import Path, PurePath
+from collections import defaultdict, namedtuple
 from textwrap import dedent
 
 DEFAULT_CONFIG = """startup=0
@@ -40,6 +39,12 @@ gpu_passthrough_nvidia=0
 # Turning off seccomp filtering improves performance at the expense of security
 seccomp=1
 
+# Space separated names of jails to start before this jail when running: jlmkr startup
+# Jails listed in requires= are started too (even without startup=1)
+# and this jail is skipped when one of them fails to start
+after=
+requires=
+
 # Below you may add additional systemd-nspawn flags behind systemd_nspawn_user_args=
 # To mount host storage in the jail, you may add: --bind='/mnt/pool/dataset:/home'
 # To readonly mount host storage, you may add: --bind-ro=/etc/certificates
@@ -74,6 +79,10 @@ post_start_hook=
 post_stop_hook=
 # post_stop_hook=echo 'POST_STOP_HOOK_EXAMPLE'
 
+# Seconds to wait for the jail to shutdown before forcefully terminating it
+# Set to 0 to wait indefinitely
+stop_timeout=90
+
 # Only used while creating the jail
 distro=debian
 release=bookworm
@@ -123,9 +132,42 @@ SCRIPT_NAME = os.path.basename(SCRIPT_PATH)
 SCRIPT_DIR_PATH = os.path.dirname(SCRIPT_PATH)
 COMMAND_NAME = os.path.basename(__file__)
 JAILS_DIR_PATH = os.path.join(SCRIPT_DIR_PATH, "jails")
+# Pristine rootfs per distro and release (ZFS only) and baked images to create jails from
+IMAGES_DIR_PATH = os.path.join(SCRIPT_DIR_PATH, "images")
+GOLDEN_SNAPSHOT_NAME = "golden"
+# Rootfs tarballs by sha256 digest, which may be shared between hosts (e.g. by symlinking it)
+IMAGE_STORE_PATH = os.path.join(SCRIPT_DIR_PATH, ".lxc", "store")
+IMAGE_SERVER_URL = "https://images.linuxcontainers.org"
+IMAGE_ARCH = "amd64"
+IMAGE_VARIANT = "default"
+HISTORY_DB_PATH = os.path.join(SCRIPT_DIR_PATH, ".history.sqlite")
+MACHINES_STATE_DIR_PATH = "/run/systemd/machines"
+DBUS_SYSTEM_BUS_DEFAULT_ADDRESS = "unix:path=/run/dbus/system_bus_socket"
 JAIL_CONFIG_NAME = "config"
 JAIL_ROOTFS_NAME = "rootfs"
 SHORTNAME = "jlmkr"
+RUNTIME_DIR_PATH = f"/run/{SHORTNAME}"
+DAEMON_SOCKET_PATH = os.path.join(RUNTIME_DIR_PATH, "daemon.sock")
+CONFIG_CACHE_PATH = os.path.join(RUNTIME_DIR_PATH, "config-cache")
+NVIDIA_CACHE_PATH = os.path.join(RUNTIME_DIR_PATH, "nvidia-cache")
+NVIDIA_DRIVER_VERSION_PATH = "/proc/driver/nvidia/version"
+# Commands the daemon serves, other commands always run directly
+DAEMON_COMMANDS = ["exec", "list", "start", "status", "stop"]
+# How to talk to systemd and machined: by running their CLI tools or over D-Bus
+SYSTEMD_BACKENDS = ["subprocess", "dbus"]
+systemd_backend = "subprocess"
+# Seconds to wait after each forceful step to stop a jail before escalating further
+STOP_ESCALATION_TIMEOUT = 10
+# The history command compares the last run of an operation with the median of
+# this many runs before it, and flags it when it took this many times as long
+HISTORY_BASELINE_RUNS = 10
+HISTORY_REGRESSION_FACTOR = 1.5
+# The openat2 syscall number is the same on all architectures
+SYS_OPENAT2 = 437
+RESOLVE_IN_ROOT = 0x10
+# Upper bound of the number of operations on jails which run at once,
+# so bulk commands can't oversubscribe the host
+MAX_JOBS = os.cpu_count() or 1
 
 # Only set a color if we have an interactive tty
 if sys.stdout.isatty():
@@ -144,123 +186,175 @@ DISCLAIMER = f"""{YELLOW}{BOLD}{__disclaimer__}{NORMAL}"""
 _UNSET = object()
 
 
-class KeyValueParser(configparser.ConfigParser):
-    """Simple comment preserving parser based on ConfigParser.
-    Reads a file containing key/value pairs and/or comments.
-    Values can span multiple lines, as long as they are indented
-    deeper than the first line of the value. Comments or keys
-    must NOT be indented.
-    """
-
-    def __init__(self, *args, **kwargs):
-        # Set defaults if not specified by user
-        if "interpolation" not in kwargs:
-            kwargs["interpolation"] = None
-        if "allow_no_value" not in kwargs:
-            kwargs["allow_no_value"] = True
-        if "comment_prefixes" not in kwargs:
-            kwargs["comment_prefixes"] = "#"
-
-        super().__init__(*args, **kwargs)
-
-        # Backup _comment_prefixes
-        self._comment_prefixes_backup = self._comment_prefixes
-        # Unset _comment_prefixes so comments won't be skipped
-        self._comment_prefixes = ()
-        # Starting point for the comment IDs
-        self._comment_id = 0
-        # Default delimiter to use
-        delimiter = self._delimiters[0]
-        # Template to store comments as key value pair
-        self._comment_template = "#{0} " + delimiter + " {1}"
-        # Regex to match the comment prefix
-        self._comment_regex = re.compile(
-            r"^#\d+\s*" + re.escape(delimiter) + r"[^\S\n]*"
-        )
-        # Regex to match cosmetic newlines (skips newlines in multiline values):
-        # consecutive whitespace from start of line followed by a line not starting with whitespace
-        self._cosmetic_newlines_regex = re.compile(r"^(\s+)(?=^\S)", re.MULTILINE)
-        # Dummy section name
-        self._section_name = "a"
-
-    def _find_cosmetic_newlines(self, text):
-        # Indices of the lines containing cosmetic newlines
-        cosmetic_newline_indices = set()
-        for match in re.finditer(self._cosmetic_newlines_regex, text):
-            start_index = text.count("\n", 0, match.start())
-            end_index = start_index + text.count("\n", match.start(), match.end())
-            cosmetic_newline_indices.update(range(start_index, end_index))
-
-        return cosmetic_newline_indices
-
-    # TODO: can I create a solution which not depends on the internal _read method?
-    def _read(self, fp, fpname):
-        lines = fp.readlines()
-        cosmetic_newline_indices = self._find_cosmetic_newlines("".join(lines))
-        # Preprocess config file to preserve comments
-        for i, line in enumerate(lines):
-            if i in cosmetic_newline_indices or line.startswith(
-                self._comment_prefixes_backup
-            ):
-                # Store cosmetic newline or comment with unique key
-                lines[i] = self._comment_template.format(self._comment_id, line)
-                self._comment_id += 1
-
-        # Convert to in-memory file and prepend a dummy section header
-        lines = io.StringIO(f"[{self._section_name}]\n" + "".join(lines))
-        # Feed preprocessed file to original _read method
-        return super()._read(lines, fpname)
-
-    def read_default_string(self, string, source="<string>"):
-        # Ignore all comments when parsing default key/values
-        string = "\n".join(
-            [
-                line
-                for line in string.splitlines()
-                if not line.startswith(self._comment_prefixes_backup)
-            ]
-        )
-        # Feed preprocessed file to original _read method
-        return super()._read(io.StringIO("[DEFAULT]\n" + string), source)
+@functools.cache
+def get_key_value_parser_class():
+    """
+    Return the KeyValueParser class, importing configparser on first use.
+    """
+    import configparser
+
+    class KeyValueParser(configparser.ConfigParser):
+        """Simple comment preserving parser based on ConfigParser.
+        Reads a file containing key/value pairs and/or comments.
+        Values can span multiple lines, as long as they are indented
+        deeper than the first line of the value. Comments or keys
+        must NOT be indented.
+        """
+
+        def __init__(self, *args, **kwargs):
+            # Set defaults if not specified by user
+            if "interpolation" not in kwargs:
+                kwargs["interpolation"] = None
+            if "allow_no_value" not in kwargs:
+                kwargs["allow_no_value"] = True
+            if "comment_prefixes" not in kwargs:
+                kwargs["comment_prefixes"] = "#"
+
+            super().__init__(*args, **kwargs)
+
+            # Backup _comment_prefixes
+            self._comment_prefixes_backup = self._comment_prefixes
+            # Unset _comment_prefixes so comments won't be skipped
+            self._comment_prefixes = ()
+            # Starting point for the comment IDs
+            self._comment_id = 0
+            # Default delimiter to use
+            delimiter = self._delimiters[0]
+            # Template to store comments as key value pair
+            self._comment_template = "#{0} " + delimiter + " {1}"
+            # Regex to match the comment prefix
+            self._comment_regex = re.compile(
+                r"^#\d+\s*" + re.escape(delimiter) + r"[^\S\n]*"
+            )
+            # Regex to match cosmetic newlines (skips newlines in multiline values):
+            # consecutive whitespace from start of line followed by a line not starting with whitespace
+            self._cosmetic_newlines_regex = re.compile(r"^(\s+)(?=^\S)", re.MULTILINE)
+            # Dummy section name
+            self._section_name = "a"
+
+        def _find_cosmetic_newlines(self, text):
+            # Indices of the lines containing cosmetic newlines
+            cosmetic_newline_indices = set()
+            for match in re.finditer(self._cosmetic_newlines_regex, text):
+                start_index = text.count("\n", 0, match.start())
+                end_index = start_index + text.count("\n", match.start(), match.end())
+                cosmetic_newline_indices.update(range(start_index, end_index))
+
+            return cosmetic_newline_indices
+
+        # TODO: can I create a solution which not depends on the internal _read method?
+        def _read(self, fp, fpname):
+            lines = fp.readlines()
+            cosmetic_newline_indices = self._find_cosmetic_newlines("".join(lines))
+            # Preprocess config file to preserve comments
+            for i, line in enumerate(lines):
+                if i in cosmetic_newline_indices or line.startswith(
+                    self._comment_prefixes_backup
+                ):
+                    # Store cosmetic newline or comment with unique key
+                    lines[i] = self._comment_template.format(self._comment_id, line)
+                    self._comment_id += 1
+
+            # Convert to in-memory file and prepend a dummy section header
+            lines = io.StringIO(f"[{self._section_name}]\n" + "".join(lines))
+            # Feed preprocessed file to original _read method
+            return super()._read(lines, fpname)
+
+        def read_default_string(self, string, source="<string>"):
+            # Ignore all comments when parsing default key/values
+            string = "\n".join(
+                [
+                    line
+                    for line in string.splitlines()
+                    if not line.startswith(self._comment_prefixes_backup)
+                ]
+            )
+            # Feed preprocessed file to original _read method
+            return super()._read(io.StringIO("[DEFAULT]\n" + string), source)
 
-    def write(self, fp, space_around_delimiters=False):
-        # Write the config to an in-memory file
-        with io.StringIO() as sfile:
-            super().write(sfile, space_around_delimiters)
-            # Start from the beginning of sfile
-            sfile.seek(0)
+        def write(self, fp, space_around_delimiters=False):
+            # Write the config to an in-memory file
+            with io.StringIO() as sfile:
+                super().write(sfile, space_around_delimiters)
+                # Start from the beginning of sfile
+                sfile.seek(0)
 
-            line = sfile.readline()
-            # Throw away lines until we reach the dummy section header
-            while line.strip() != f"[{self._section_name}]":
                 line = sfile.readline()
+                # Throw away lines until we reach the dummy section header
+                while line.strip() != f"[{self._section_name}]":
+                    line = sfile.readline()
+
+                lines = sfile.readlines()
+
+            for i, line in enumerate(lines):
+                # Remove the comment id prefix
+                lines[i] = self._comment_regex.sub("", line, 1)
 
-            lines = sfile.readlines()
+            fp.write("".join(lines).rstrip())
 
-        for i, line in enumerate(lines):
-            # Remove the comment id prefix
-            lines[i] = self._comment_regex.sub("", line, 1)
+        # Set value for specified option key
+        def my_set(self, option, value):
+            if isinstance(value, bool):
+                value = str(int(value))
+            elif isinstance(value, list):
+                value = str("\n    ".join(value))
+            elif not isinstance(value, str):
+                value = str(value)
 
-        fp.write("".join(lines).rstrip())
+            super().set(self._section_name, option, value)
 
-    # Set value for specified option key
-    def my_set(self, option, value):
-        if isinstance(value, bool):
-            value = str(int(value))
-        elif isinstance(value, list):
-            value = str("\n    ".join(value))
-        elif not isinstance(value, str):
-            value = str(value)
+        # Return value for specified option key
+        def my_get(self, option, fallback=_UNSET):
+            return super().get(self._section_name, option, fallback=fallback)
 
-        super().set(self._section_name, option, value)
+        # Return value converted to boolean for specified option key
+        def my_getboolean(self, option, fallback=_UNSET):
+            return super().getboolean(self._section_name, option, fallback=fallback)
+
+    return KeyValueParser
+
+
+def new_key_value_parser():
+    return get_key_value_parser_class()()
+
+
+class CachedConfig:
+    """
+    Read-only config with the effective values of a jail config file,
+    offering the getters of KeyValueParser without having to parse the file again.
+    """
+
+    # Same as configparser.ConfigParser.BOOLEAN_STATES
+    BOOLEAN_STATES = {
+        "1": True,
+        "yes": True,
+        "true": True,
+        "on": True,
+        "0": False,
+        "no": False,
+        "false": False,
+        "off": False,
+    }
+
+    def __init__(self, values):
+        self.values = values
 
     # Return value for specified option key
     def my_get(self, option, fallback=_UNSET):
-        return super().get(self._section_name, option, fallback=fallback)
+        if option in self.values:
+            return self.values[option]
+        if fallback is _UNSET:
+            raise KeyError(option)
+        return fallback
 
     # Return value converted to boolean for specified option key
     def my_getboolean(self, option, fallback=_UNSET):
-        return super().getboolean(self._section_name, option, fallback=fallback)
+        if option not in self.values and fallback is not _UNSET:
+            return fallback
+        value = self.my_get(option)
+        if value.lower() not in self.BOOLEAN_STATES:
+            raise ValueError(f"Not a boolean: {value}")
+        return self.BOOLEAN_STATES[value.lower()]
 
 
 class ExceptionWithParser(Exception):
@@ -270,34 +364,520 @@ class ExceptionWithParser(Exception):
         super().__init__(message)
 
 
-# Workaround for exit_on_error=False not applying to:
-# "error: the following arguments are required"
-# https://github.com/python/cpython/issues/103498
-class CustomSubParser(argparse.ArgumentParser):
-    def error(self, message):
-        if self.exit_on_error:
-            super().error(message)
-        else:
-            raise ExceptionWithParser(self, message)
+class JailmakerError(Exception):
+    """
+    Raised by the API functions when an operation on a jail fails.
+    """
+
+    def __init__(self, message, returncode=1):
+        self.message = message
+        self.returncode = returncode
+        super().__init__(message)
+
+
+# Results of the API functions, these allow importing jlmkr.py as a module
+# and managing jails from Python without parsing the output of the commands
+JailInfo = namedtuple(
+    "JailInfo",
+    [
+        "name",
+        "running",
+        "startup",
+        "gpu_intel",
+        "gpu_nvidia",
+        "os",
+        "version",
+        "addresses",
+    ],
+)
+# Started is False when the jail was running already
+StartResult = namedtuple("StartResult", ["name", "started", "duration"])
+# Stage is the action which stopped the jail: poweroff, terminate or SIGKILL
+StopResult = namedtuple("StopResult", ["name", "stage", "duration"])
+# Returncode is None when the operation timed out, output is None when not captured
+OperationResult = namedtuple(
+    "OperationResult", ["name", "returncode", "output", "duration"]
+)
+
+
+def get_custom_sub_parser_class():
+    import argparse
+
+    # Workaround for exit_on_error=False not applying to:
+    # "error: the following arguments are required"
+    # https://github.com/python/cpython/issues/103498
+    class CustomSubParser(argparse.ArgumentParser):
+        def error(self, message):
+            if self.exit_on_error:
+                super().error(message)
+            else:
+                raise ExceptionWithParser(self, message)
+
+    return CustomSubParser
+
+
+@functools.cache
+def get_openat2():
+    """
+    Return a function calling the openat2 syscall with RESOLVE_IN_ROOT,
+    which resolves a path as if dirfd was the root directory.
+    """
+    import ctypes
+
+    libc = ctypes.CDLL(None, use_errno=True)
+
+    class OpenHow(ctypes.Structure):
+        _fields_ = [
+            ("flags", ctypes.c_uint64),
+            ("mode", ctypes.c_uint64),
+            ("resolve", ctypes.c_uint64),
+        ]
+
+    def openat2_in_root(dirfd, path, flags):
+        how = OpenHow(flags | os.O_CLOEXEC, 0, RESOLVE_IN_ROOT)
+        fd = libc.syscall(
+            ctypes.c_long(SYS_OPENAT2),
+            ctypes.c_int(dirfd),
+            ctypes.c_char_p(os.fsencode(path)),
+            ctypes.byref(how),
+            ctypes.c_size_t(ctypes.sizeof(how)),
+        )
+        if fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+        return fd
+
+    return openat2_in_root
+
+
+def walk_in_root(root, path):
+    """
+    Resolve path in userspace as if root was the root directory: symlinks are followed,
+    but neither absolute symlinks nor .. can lead outside of root.
+    """
+    remaining = path.split("/")[::-1]
+    resolved = []
+    symlinks = 0
+
+    while remaining:
+        part = remaining.pop()
+        if part in ("", "."):
+            continue
+        if part == "..":
+            if resolved:
+                resolved.pop()
+            continue
+
+        current = os.path.join(root, *resolved, part)
+        if not os.path.islink(current):
+            resolved.append(part)
+            continue
+
+        # Same limit as the kernel
+        symlinks += 1
+        if symlinks > 40:
+            raise OSError(errno.ELOOP, os.strerror(errno.ELOOP), path)
+
+        target = os.readlink(current)
+        if target.startswith("/"):
+            resolved = []
+        remaining.extend(target.split("/")[::-1])
+
+    return os.path.join(root, *resolved)
+
 
+def open_in_root(root, path, flags=os.O_RDONLY):
+    """
+    Open path as if root was the root directory and return the file descriptor.
+    Unlike chroot this doesn't change process wide state, so it's safe to use from threads.
+    """
+    root_fd = os.open(root, os.O_PATH | os.O_DIRECTORY | os.O_CLOEXEC)
+    try:
+        try:
+            return get_openat2()(root_fd, path, flags)
+        except OSError as error:
+            # Fallback for kernels before 5.6
+            if error.errno != errno.ENOSYS:
+                raise
+
+        # Refuse to follow a symlink which replaced the last component in the meantime
+        return os.open(walk_in_root(root, path), flags | os.O_NOFOLLOW | os.O_CLOEXEC)
+    finally:
+        os.close(root_fd)
+
+
+def resolve_in_root(root, path):
+    """
+    Return the path on the host of an existing path as if root was the root directory.
+    """
+    fd = open_in_root(root, path, os.O_PATH)
+    try:
+        return os.readlink(f"/proc/self/fd/{fd}")
+    finally:
+        os.close(fd)
+
+
+class MachinesWatch:
+    """
+    Watch the machined state directory for machines being registered or removed.
+    Falls back to waking up every second when inotify can't be used.
+    """
+
+    # Machined writes state files to a temporary file and renames them into place
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
 
-class Chroot:
-    def __init__(self, new_root):
-        self.new_root = new_root
-        self.old_root = None
-        self.initial_cwd = None
+    def __init__(self, path=MACHINES_STATE_DIR_PATH):
+        self.path = path
+        self.fd = None
 
     def __enter__(self):
-        self.old_root = os.open("/", os.O_PATH)
-        self.initial_cwd = os.path.abspath(os.getcwd())
-        os.chdir(self.new_root)
-        os.chroot(".")
+        import ctypes
+
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd < 0:
+                return self
+            mask = self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE
+            if libc.inotify_add_watch(fd, os.fsencode(self.path), mask) < 0:
+                os.close(fd)
+                return self
+            self.fd = fd
+        except (AttributeError, OSError):
+            pass
+
+        return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        os.chdir(self.old_root)
-        os.chroot(".")
-        os.close(self.old_root)
-        os.chdir(self.initial_cwd)
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def wait(self, timeout):
+        """
+        Block until a machine state file changes or the timeout (in seconds) expires.
+        Returns False on timeout, but always True when polling.
+        """
+        if self.fd is None:
+            time.sleep(min(timeout, 1))
+            return True
+
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return False
+
+        # Drain the pending events, we only need to know that something changed
+        with contextlib.suppress(BlockingIOError):
+            while os.read(self.fd, 4096):
+                pass
+
+        return True
+
+
+class DBusError(Exception):
+    def __init__(self, name, message):
+        self.name = name
+        self.message = message
+        super().__init__(f"{name}: {message}")
+
+
+class DBusConnection:
+    """
+    Minimal D-Bus client, just enough to call methods of systemd and machined.
+    Connects to the bus in $DBUS_SYSTEM_BUS_ADDRESS or else the system bus.
+    https://dbus.freedesktop.org/doc/dbus-specification.html
+    """
+
+    METHOD_CALL = 1
+    METHOD_RETURN = 2
+    ERROR = 3
+
+    # Header field codes and their types
+    FIELD_TYPES = {1: "o", 2: "s", 3: "s", 4: "s", 5: "u", 6: "s", 7: "s", 8: "g"}
+    PATH, INTERFACE, MEMBER, ERROR_NAME, REPLY_SERIAL, DESTINATION = range(1, 7)
+    SENDER, SIGNATURE = 7, 8
+
+    # Struct format and alignment of the fixed size types
+    FIXED_TYPES = {
+        "y": ("B", 1),
+        "b": ("I", 4),
+        "n": ("h", 2),
+        "q": ("H", 2),
+        "i": ("i", 4),
+        "u": ("I", 4),
+        "x": ("q", 8),
+        "t": ("Q", 8),
+        "d": ("d", 8),
+        "h": ("I", 4),
+    }
+    ALIGNMENT = {"s": 4, "o": 4, "g": 1, "a": 4, "(": 8, "{": 8, "v": 1}
+
+    def __init__(self, address=None):
+        import socket
+
+        address = (
+            address
+            or os.environ.get("DBUS_SYSTEM_BUS_ADDRESS")
+            or DBUS_SYSTEM_BUS_DEFAULT_ADDRESS
+        )
+        self.serial = 0
+        self.buffer = b""
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.connect(self.parse_address(address))
+            self.authenticate()
+            self.call(
+                "org.freedesktop.DBus",
+                "/org/freedesktop/DBus",
+                "org.freedesktop.DBus",
+                "Hello",
+            )
+        except BaseException:
+            self.sock.close()
+            raise
+
+    @staticmethod
+    def parse_address(address):
+        """
+        Return the socket path of the first unix transport in a D-Bus address.
+        """
+        import urllib.parse
+
+        for transport in address.split(";"):
+            kind, _, params = transport.partition(":")
+            if kind != "unix":
+                continue
+            params = dict(x.partition("=")[::2] for x in params.split(","))
+            if "path" in params:
+                return urllib.parse.unquote(params["path"])
+            if "abstract" in params:
+                return "\0" + urllib.parse.unquote(params["abstract"])
+
+        raise DBusError(
+            "org.freedesktop.DBus.Error.BadAddress", f"Unsupported address {address}"
+        )
+
+    def close(self):
+        self.sock.close()
+
+    def recv_exactly(self, size):
+        while len(self.buffer) < size:
+            chunk = self.sock.recv(max(4096, size - len(self.buffer)))
+            if not chunk:
+                raise ConnectionError("D-Bus connection closed")
+            self.buffer += chunk
+
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def authenticate(self):
+        uid = str(os.getuid()).encode().hex().encode()
+        self.sock.sendall(b"\0AUTH EXTERNAL " + uid + b"\r\n")
+
+        while b"\r\n" not in self.buffer:
+            chunk = self.sock.recv(4096)
+            if not chunk:
+                raise ConnectionError("D-Bus connection closed")
+            self.buffer += chunk
+        line, _, self.buffer = self.buffer.partition(b"\r\n")
+
+        if not line.startswith(b"OK"):
+            raise DBusError(
+                "org.freedesktop.DBus.Error.AuthFailed", line.decode(errors="replace")
+            )
+        self.sock.sendall(b"BEGIN\r\n")
+
+    @classmethod
+    def split_signature(cls, signature):
+        """
+        Split a signature into its complete types.
+        """
+        types = []
+        i = 0
+        while i < len(signature):
+            start = i
+            while signature[i] == "a":
+                i += 1
+            if signature[i] in "({":
+                depth = 0
+                while True:
+                    depth += signature[i] in "({"
+                    depth -= signature[i] in ")}"
+                    i += 1
+                    if not depth:
+                        break
+            else:
+                i += 1
+            types.append(signature[start:i])
+
+        return types
+
+    @classmethod
+    def alignment(cls, type_code):
+        return (
+            cls.FIXED_TYPES.get(type_code, (None, None))[1] or cls.ALIGNMENT[type_code]
+        )
+
+    @classmethod
+    def marshal(cls, buf, signature, values):
+        for type_code, value in zip(cls.split_signature(signature), values):
+            cls.marshal_value(buf, type_code, value)
+
+    @classmethod
+    def marshal_value(cls, buf, type_code, value):
+        buf.extend(b"\0" * (-len(buf) % cls.alignment(type_code[0])))
+
+        if type_code in cls.FIXED_TYPES:
+            buf.extend(struct.pack("<" + cls.FIXED_TYPES[type_code][0], value))
+        elif type_code in "so":
+            data = value.encode()
+            buf.extend(struct.pack("<I", len(data)) + data + b"\0")
+        elif type_code == "g":
+            data = value.encode()
+            buf.extend(struct.pack("<B", len(data)) + data + b"\0")
+        elif type_code == "v":
+            signature, inner_value = value
+            cls.marshal_value(buf, "g", signature)
+            cls.marshal_value(buf, signature, inner_value)
+        elif type_code[0] == "a":
+            length_offset = len(buf)
+            buf.extend(b"\0\0\0\0")
+            element_type = type_code[1:]
+            buf.extend(b"\0" * (-len(buf) % cls.alignment(element_type[0])))
+            start = len(buf)
+            if element_type[0] == "{":
+                value = value.items()
+            for element in value:
+                cls.marshal_value(buf, element_type, element)
+            struct.pack_into("<I", buf, length_offset, len(buf) - start)
+        else:
+            cls.marshal(buf, type_code[1:-1], value)
+
+    @classmethod
+    def unmarshal(cls, data, offset, signature, endian="<"):
+        values = []
+        for type_code in cls.split_signature(signature):
+            value, offset = cls.unmarshal_value(data, offset, type_code, endian)
+            values.append(value)
+
+        return values, offset
+
+    @classmethod
+    def unmarshal_value(cls, data, offset, type_code, endian="<"):
+        offset += -offset % cls.alignment(type_code[0])
+
+        if type_code in cls.FIXED_TYPES:
+            fmt = endian + cls.FIXED_TYPES[type_code][0]
+            value = struct.unpack_from(fmt, data, offset)[0]
+            if type_code == "b":
+                value = bool(value)
+            return value, offset + struct.calcsize(fmt)
+        elif type_code in "so":
+            length = struct.unpack_from(endian + "I", data, offset)[0]
+            offset += 4
+            return data[offset : offset + length].decode(), offset + length + 1
+        elif type_code == "g":
+            length = data[offset]
+            offset += 1
+            return data[offset : offset + length].decode(), offset + length + 1
+        elif type_code == "v":
+            signature, offset = cls.unmarshal_value(data, offset, "g", endian)
+            value, offset = cls.unmarshal_value(data, offset, signature, endian)
+            return (signature, value), offset
+        elif type_code[0] == "a":
+            length = struct.unpack_from(endian + "I", data, offset)[0]
+            element_type = type_code[1:]
+            offset += 4
+            offset += -offset % cls.alignment(element_type[0])
+            end = offset + length
+            elements = []
+            while offset < end:
+                element, offset = cls.unmarshal_value(
+                    data, offset, element_type, endian
+                )
+                elements.append(element)
+            if element_type[0] == "{":
+                elements = dict(elements)
+            return elements, offset
+        else:
+            values, offset = cls.unmarshal(data, offset, type_code[1:-1], endian)
+            return tuple(values), offset
+
+    def send(self, message_type, fields, signature="", args=(), flags=0):
+        """
+        Send a message with given header fields and body. Returns its serial.
+        """
+        body = bytearray()
+        # The body starts at an 8 byte boundary, so alignment relative to it is the same
+        self.marshal(body, signature, args)
+        if signature:
+            fields = {**fields, self.SIGNATURE: signature}
+
+        self.serial += 1
+        message = bytearray(
+            b"l" + struct.pack("<BBBII", message_type, flags, 1, len(body), self.serial)
+        )
+        self.marshal_value(
+            message,
+            "a(yv)",
+            [(code, (self.FIELD_TYPES[code], value)) for code, value in fields.items()],
+        )
+        message.extend(b"\0" * (-len(message) % 8))
+        self.sock.sendall(message + body)
+
+        return self.serial
+
+    def receive(self):
+        """
+        Receive a message. Returns its type, header fields, body and serial.
+        """
+        header = self.recv_exactly(16)
+        endian = "<" if header[:1] == b"l" else ">"
+        message_type = header[1]
+        body_length, serial, fields_length = struct.unpack_from(
+            endian + "III", header, 4
+        )
+        body_offset = 16 + fields_length + (-(16 + fields_length) % 8)
+        data = header + self.recv_exactly(body_offset - 16 + body_length)
+
+        fields, _ = self.unmarshal_value(data, 12, "a(yv)", endian)
+        fields = {code: value for code, (_, value) in fields}
+        body, _ = self.unmarshal(
+            data, body_offset, fields.get(self.SIGNATURE, ""), endian
+        )
+
+        return message_type, fields, body, serial
+
+    def call(self, destination, path, interface, member, signature="", args=()):
+        """
+        Call a method and wait for its reply. Returns the values in the reply.
+        """
+        serial = self.send(
+            self.METHOD_CALL,
+            {
+                self.PATH: path,
+                self.INTERFACE: interface,
+                self.MEMBER: member,
+                self.DESTINATION: destination,
+            },
+            signature,
+            args,
+        )
+
+        while True:
+            message_type, fields, body, _ = self.receive()
+            # Ignore signals and other unrelated messages
+            if fields.get(self.REPLY_SERIAL) != serial:
+                continue
+
+            if message_type == self.ERROR:
+                raise DBusError(
+                    fields.get(self.ERROR_NAME),
+                    body[0] if body and isinstance(body[0], str) else "",
+                )
+
+            return body
 
 
 def eprint(*args, **kwargs):
@@ -315,6 +895,113 @@ def fail(*args, **kwargs):
     sys.exit(1)
 
 
+# Trace events recorded when running with --trace, in the Chrome trace event format
+_trace_events = None
+_trace_path = None
+
+
+def add_trace_event(name, category, start_ns, end_ns, args):
+    """
+    Record a complete event which took from start_ns until end_ns (monotonic clock).
+    """
+    if _trace_events is None:
+        return
+
+    _trace_events.append(
+        {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": start_ns / 1000,
+            "dur": (end_ns - start_ns) / 1000,
+            "pid": os.getpid(),
+            "tid": threading.get_native_id(),
+            "args": args,
+        }
+    )
+
+
+@contextlib.contextmanager
+def trace(name, **args):
+    """
+    Record the duration of the code in the with block as a phase, when tracing.
+    """
+    if _trace_events is None:
+        yield
+        return
+
+    start_ns = time.monotonic_ns()
+    try:
+        yield
+    finally:
+        add_trace_event(name, "phase", start_ns, time.monotonic_ns(), args)
+
+
+@functools.cache
+def get_traced_popen_class():
+    """
+    Return a subprocess.Popen subclass which records each process it runs.
+    """
+
+    class TracedPopen(subprocess.Popen):
+        def __init__(self, args, *other_args, **kwargs):
+            self._trace_start_ns = time.monotonic_ns()
+            self._trace_argv = [
+                os.fsdecode(x)
+                for x in (
+                    [args] if isinstance(args, (str, bytes, os.PathLike)) else args
+                )
+            ]
+            try:
+                super().__init__(args, *other_args, **kwargs)
+            except OSError as error:
+                self._add_trace_event(error=str(error))
+                raise
+
+        def _add_trace_event(self, **args):
+            add_trace_event(
+                os.path.basename(self._trace_argv[0]),
+                "subprocess",
+                self._trace_start_ns,
+                time.monotonic_ns(),
+                {"argv": self._trace_argv, **args},
+            )
+
+        # TODO: can I create a solution which not depends on the internal _handle_exitstatus method?
+        def _handle_exitstatus(self, *args, **kwargs):
+            # Called once the process has exited, be it from wait(), poll() or run()
+            super()._handle_exitstatus(*args, **kwargs)
+            self._add_trace_event(returncode=self.returncode)
+
+    return TracedPopen
+
+
+def start_tracing(trace_path):
+    """
+    Record the phases of the commands and every process they run, until write_trace.
+    """
+    global _trace_events, _trace_path
+
+    _trace_events = []
+    _trace_path = trace_path
+    # Every function of the subprocess module creates its processes with Popen
+    subprocess.Popen = get_traced_popen_class()
+
+
+def write_trace():
+    """
+    Write the recorded trace events to the file passed to start_tracing.
+    The file can be opened with https://ui.perfetto.dev or chrome://tracing.
+    """
+    import json
+
+    if _trace_events is None:
+        return
+
+    with open(_trace_path, "w") as f:
+        json.dump({"traceEvents": _trace_events, "displayTimeUnit": "ms"}, f)
+
+
 def get_jail_path(jail_name):
     return os.path.join(JAILS_DIR_PATH, jail_name)
 
@@ -350,18 +1037,41 @@ def passthrough_intel(gpu_passthrough_intel, systemd_nspawn_additional_args):
     systemd_nspawn_additional_args.append("--bind=/dev/dri")
 
 
-def passthrough_nvidia(
-    gpu_passthrough_nvidia, systemd_nspawn_additional_args, jail_name
-):
-    jail_rootfs_path = get_jail_rootfs_path(jail_name)
-    ld_so_conf_path = Path(
-        os.path.join(jail_rootfs_path), f"etc/ld.so.conf.d/{SHORTNAME}-nvidia.conf"
-    )
+def read_nvidia_driver_version():
+    """
+    Return the version info of the loaded nvidia kernel module, or None if not loaded.
+    """
+    try:
+        with open(NVIDIA_DRIVER_VERSION_PATH) as f:
+            return f.read()
+    except OSError:
+        return None
 
-    if not gpu_passthrough_nvidia:
-        # Cleanup the config file we made when passthrough was enabled
-        ld_so_conf_path.unlink(missing_ok=True)
-        return
+
+def get_nvidia_libraries_digest(driver_version, nvidia_libraries):
+    """
+    Return a digest identifying the driver version and its set of libraries.
+    """
+    import hashlib
+
+    return hashlib.sha256(
+        "\n".join([driver_version or "", *sorted(nvidia_libraries)]).encode()
+    ).hexdigest()
+
+
+def discover_nvidia_files():
+    """
+    Initialize the nvidia driver and return its version along with the sets of
+    libraries and other files to mount into a jail, or None when the GPU isn't usable.
+    The result is cached per driver version in NVIDIA_CACHE_PATH, which lives until reboot,
+    so when starting several jails the driver only needs to be initialized and queried once.
+    """
+    driver_version = read_nvidia_driver_version()
+    if driver_version and (
+        cached := read_runtime_cache(NVIDIA_CACHE_PATH, driver_version)
+    ):
+        nvidia_libraries, nvidia_files = cached
+        return driver_version, set(nvidia_libraries), set(nvidia_files)
 
     # Load the nvidia kernel module
     if subprocess.run(["modprobe", "nvidia-current-uvm"]).returncode != 0:
@@ -378,7 +1088,7 @@ def passthrough_nvidia(
     # we shouldn't continue with gpu passthrough
     if subprocess.run(["nvidia-smi", "-f", "/dev/null"]).returncode != 0:
         eprint("Skip passthrough of nvidia GPU.")
-        return
+        return None
 
     try:
         # Get list of libraries
@@ -413,8 +1123,39 @@ def passthrough_nvidia(
         Skip passthrough of nvidia GPU."""
             )
         )
+        return None
+
+    # The module may only have been loaded by the commands above
+    if driver_version := read_nvidia_driver_version():
+        write_runtime_cache(
+            NVIDIA_CACHE_PATH,
+            driver_version,
+            (sorted(nvidia_libraries), sorted(nvidia_files)),
+        )
+
+    return driver_version, nvidia_libraries, nvidia_files
+
+
+def passthrough_nvidia(
+    gpu_passthrough_nvidia, systemd_nspawn_additional_args, jail_name
+):
+    from pathlib import Path
+
+    jail_rootfs_path = get_jail_rootfs_path(jail_name)
+    ld_so_conf_path = Path(
+        os.path.join(jail_rootfs_path), f"etc/ld.so.conf.d/{SHORTNAME}-nvidia.conf"
+    )
+
+    if not gpu_passthrough_nvidia:
+        # Cleanup the config file we made when passthrough was enabled
+        ld_so_conf_path.unlink(missing_ok=True)
+        return
+
+    if not (discovered := discover_nvidia_files()):
         return
 
+    driver_version, nvidia_libraries, nvidia_files = discovered
+
     # Also make nvidia-smi available inside the path,
     # while mounting the symlink will be resolved and nvidia-smi will appear as a regular file
     nvidia_files.add("/usr/bin/nvidia-smi")
@@ -439,15 +1180,22 @@ def passthrough_nvidia(
         for lf in library_folders:
             nvidia_mounts.append(f"--bind-ro={lf}")
 
-        # Only write if the conf file doesn't yet exist or has different contents
-        existing_conf_libraries = set()
+        # The comment records the library set the ld.so cache was last built for,
+        # so a driver update with libraries in the same folders is noticed as well
+        conf = "\n".join(
+            [
+                f"# {get_nvidia_libraries_digest(driver_version, nvidia_libraries)}",
+                *sorted(library_folders),
+            ]
+        )
+
+        # Only write (and run ldconfig) if the conf file doesn't yet exist or has different contents
+        existing_conf = None
         if ld_so_conf_path.exists():
-            existing_conf_libraries.update(
-                x for x in ld_so_conf_path.read_text().splitlines() if x
-            )
+            existing_conf = ld_so_conf_path.read_text().strip()
 
-        if library_folders != existing_conf_libraries:
-            print("\n".join(x for x in library_folders), file=ld_so_conf_path.open("w"))
+        if conf != existing_conf:
+            print(conf, file=ld_so_conf_path.open("w"))
 
             # Run ldconfig inside systemd-nspawn jail with nvidia mounts...
             subprocess.run(
@@ -473,42 +1221,131 @@ def passthrough_nvidia(
     systemd_nspawn_additional_args += nvidia_mounts
 
 
+def get_exec_command(jail_name, cmd):
+    return [
+        "systemd-run",
+        "--machine",
+        jail_name,
+        "--quiet",
+        "--pipe",
+        "--wait",
+        "--collect",
+        "--service-type=exec",
+        *cmd,
+    ]
+
+
 def exec_jail(jail_name, cmd):
     """
     Execute a command in the jail with given name.
     """
-    return subprocess.run(
-        [
-            "systemd-run",
-            "--machine",
-            jail_name,
-            "--quiet",
-            "--pipe",
-            "--wait",
-            "--collect",
-            "--service-type=exec",
-            *cmd,
-        ]
-    ).returncode
+    return subprocess.run(get_exec_command(jail_name, cmd)).returncode
 
 
-def status_jail(jail_name, args):
+def exec_jails(jail_names, cmd, jobs=MAX_JOBS, timeout=None):
     """
-    Show the status of the systemd service wrapping the jail with given name.
+    Execute a command in each jail with given name, in at most jobs jails at once.
+    Returns an OperationResult with the captured output per jail.
     """
-    # Alternatively `machinectl status jail_name` could be used
-    return subprocess.run(
-        ["systemctl", "status", f"{SHORTNAME}-{jail_name}", *args]
-    ).returncode
+    return run_operations(
+        {jail_name: get_exec_command(jail_name, cmd) for jail_name in jail_names},
+        jobs,
+        timeout,
+    )
 
 
-def log_jail(jail_name, args):
+def run_operations(operations, jobs=1, timeout=None, capture=True, on_done=None):
     """
-    Show the log file of the jail with given name.
+    Run the command of each operation (a dict of commands by jail name) as a subprocess,
+    with at most jobs (but no more than MAX_JOBS) running at once.
+    Operations which don't finish within timeout seconds are killed.
+    Calls on_done with each OperationResult as soon as it's done.
+    Returns the OperationResult per jail name.
     """
-    return subprocess.run(
-        ["journalctl", "-u", f"{SHORTNAME}-{jail_name}", *args]
-    ).returncode
+    import asyncio
+
+    async def run_operation(semaphore, jail_name, cmd):
+        async with semaphore:
+            start_time = time.monotonic()
+            start_ns = time.monotonic_ns()
+            output = bytearray()
+            process = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE if capture else None,
+                stderr=subprocess.STDOUT if capture else None,
+            )
+
+            async def read_output():
+                if capture:
+                    while chunk := await process.stdout.read(io.DEFAULT_BUFFER_SIZE):
+                        output.extend(chunk)
+                await process.wait()
+
+            try:
+                await asyncio.wait_for(read_output(), timeout)
+                returncode = process.returncode
+            except asyncio.TimeoutError:
+                returncode = None
+            finally:
+                # Also kill the process when cancelled, e.g. by Ctrl+C
+                if process.returncode is None:
+                    process.kill()
+                    await process.wait()
+
+            add_trace_event(
+                os.path.basename(cmd[0]),
+                "subprocess",
+                start_ns,
+                time.monotonic_ns(),
+                {"argv": cmd, "returncode": returncode, "jail": jail_name},
+            )
+
+            return OperationResult(
+                jail_name,
+                returncode,
+                output.decode(errors="replace") if capture else None,
+                time.monotonic() - start_time,
+            )
+
+    async def run_all():
+        semaphore = asyncio.Semaphore(max(1, min(jobs, MAX_JOBS)))
+        results = {}
+        for future in asyncio.as_completed(
+            [
+                run_operation(semaphore, jail_name, cmd)
+                for jail_name, cmd in operations.items()
+            ]
+        ):
+            result = await future
+            results[result.name] = result
+            if on_done:
+                on_done(result)
+        return results
+
+    if not operations:
+        return {}
+
+    return asyncio.run(run_all())
+
+
+def status_jail(jail_name, args):
+    """
+    Show the status of the systemd service wrapping the jail with given name.
+    """
+    # Alternatively `machinectl status jail_name` could be used
+    return subprocess.run(
+        ["systemctl", "status", f"{SHORTNAME}-{jail_name}", *args]
+    ).returncode
+
+
+def log_jail(jail_name, args):
+    """
+    Show the log file of the jail with given name.
+    """
+    return subprocess.run(
+        ["journalctl", "-u", f"{SHORTNAME}-{jail_name}", *args]
+    ).returncode
 
 
 def shell_jail(args):
@@ -518,19 +1355,135 @@ def shell_jail(args):
     return subprocess.run(["machinectl", "shell"] + args).returncode
 
 
+# Effective values of the config files, indexed by path, along with the
+# file stats they were parsed from. Persisted in CONFIG_CACHE_PATH, so other
+# invocations only need to stat the config files which didn't change.
+_config_cache = None
+_config_cache_changed = False
+# Jails may be looked up from multiple threads
+_config_cache_lock = threading.Lock()
+
+
+def get_config_cache_version():
+    """
+    Return the version of the config cache, which changes with this script (and its defaults).
+    """
+    st = os.stat(SCRIPT_PATH)
+    return (__version__, st.st_size, st.st_mtime_ns)
+
+
+def read_runtime_cache(cache_path, version):
+    """
+    Return the data stored with write_runtime_cache, or None when the cache file
+    is missing, corrupt, or was written for another version.
+    """
+    import marshal
+
+    try:
+        with open(cache_path, "rb") as f:
+            # Only trust a cache file which only we could have written
+            st = os.fstat(f.fileno())
+            if st.st_uid != os.getuid() or st.st_mode & 0o022:
+                return None
+            cached_version, data = marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+
+    return data if cached_version == version else None
+
+
+def write_runtime_cache(cache_path, version, data):
+    """
+    Atomically write data (of types supported by marshal) to a cache file in RUNTIME_DIR_PATH.
+    """
+    import marshal
+
+    tmp_path = f"{cache_path}.{os.getpid()}"
+    try:
+        os.makedirs(RUNTIME_DIR_PATH, mode=0o700, exist_ok=True)
+        with open(
+            os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "wb"
+        ) as f:
+            marshal.dump((version, data), f)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        # Caching is an optimization, e.g. when not running as root
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+
+
+def load_config_cache():
+    """
+    Return the config cache, loading it from CONFIG_CACHE_PATH on first use.
+    """
+    global _config_cache
+
+    with _config_cache_lock:
+        if _config_cache is None:
+            # Missing or corrupt cache will be rebuilt
+            _config_cache = (
+                read_runtime_cache(CONFIG_CACHE_PATH, get_config_cache_version()) or {}
+            )
+
+    return _config_cache
+
+
+def save_config_cache():
+    """
+    Atomically write the config cache to CONFIG_CACHE_PATH if it changed.
+    """
+    global _config_cache_changed
+
+    if not _config_cache_changed:
+        return
+
+    _config_cache_changed = False
+    write_runtime_cache(CONFIG_CACHE_PATH, get_config_cache_version(), _config_cache)
+
+
 def parse_config_file(jail_config_path):
-    config = KeyValueParser()
+    import atexit
+
+    global _config_cache_changed
+
+    try:
+        st = os.stat(jail_config_path)
+    except FileNotFoundError:
+        eprint(f"Unable to find config file: {jail_config_path}.")
+        return
+
+    # Any edit of the file changes at least one of these
+    stat_key = (st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+    cache = load_config_cache()
+    cached = cache.get(jail_config_path)
+    if cached and cached[0] == stat_key:
+        return CachedConfig(cached[1])
+
+    config = new_key_value_parser()
     # Read default config to fallback to default values
     # for keys not found in the jail_config_path file
     config.read_default_string(DEFAULT_CONFIG)
     try:
         with open(jail_config_path, "r") as fp:
             config.read_file(fp)
-        return config
     except FileNotFoundError:
         eprint(f"Unable to find config file: {jail_config_path}.")
         return
 
+    # Store the effective values, skipping the comments KeyValueParser keeps as keys
+    values = {
+        key: config.my_get(key)
+        for key in config[config._section_name]
+        if not key.startswith("#")
+    }
+    with _config_cache_lock:
+        cache[jail_config_path] = (stat_key, values)
+        if not _config_cache_changed:
+            _config_cache_changed = True
+            atexit.register(save_config_cache)
+
+    return CachedConfig(values)
+
 
 def systemd_escape_path(path):
     """
@@ -547,6 +1500,8 @@ def systemd_escape_path(path):
 
 
 def add_hook(jail_path, systemd_run_additional_args, hook_command, hook_type):
+    from pathlib import Path
+
     if not hook_command:
         return
 
@@ -568,27 +1523,215 @@ def add_hook(jail_path, systemd_run_additional_args, hook_command, hook_type):
     ]
 
 
-def start_jail(jail_name):
+def connect_history_db():
     """
-    Start jail with given name.
+    Return a connection to the history database, creating it when needed.
     """
-    skip_start_message = (
-        f"Skipped starting jail {jail_name}. It appears to be running already..."
+    import sqlite3
+
+    # Wait for other jlmkr.py processes which are writing, e.g. during startup
+    db = sqlite3.connect(HISTORY_DB_PATH, timeout=10)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute(
+        """CREATE TABLE IF NOT EXISTS operations (
+            id INTEGER PRIMARY KEY,
+            jail TEXT NOT NULL,
+            operation TEXT NOT NULL,
+            started_at REAL NOT NULL,
+            finished_at REAL NOT NULL,
+            duration REAL NOT NULL,
+            returncode INTEGER NOT NULL,
+            distro TEXT,
+            release TEXT
+        )"""
+    )
+    db.execute(
+        "CREATE INDEX IF NOT EXISTS operations_jail ON operations (jail, operation, started_at)"
     )
+    return db
 
-    if jail_is_running(jail_name):
-        eprint(skip_start_message)
+
+def add_history(jail_name, operation, started_at, duration, returncode):
+    """
+    Record an operation on a jail in the history database.
+    Started_at is a unix timestamp and duration is in seconds.
+    """
+    import sqlite3
+
+    distro = release = None
+    jail_config_path = get_jail_config_path(jail_name)
+    if os.path.exists(jail_config_path):
+        if config := parse_config_file(jail_config_path):
+            distro = config.my_get("distro")
+            release = config.my_get("release")
+
+    try:
+        with contextlib.closing(connect_history_db()) as db, db:
+            db.execute(
+                "INSERT INTO operations (jail, operation, started_at, finished_at, duration, returncode, distro, release) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    jail_name,
+                    operation,
+                    started_at,
+                    started_at + duration,
+                    duration,
+                    returncode,
+                    distro,
+                    release,
+                ),
+            )
+    except (sqlite3.Error, OSError) as error:
+        # The history is only informational, never fail an operation over it
+        eprint(
+            f"Failed to record {operation} of jail {jail_name} in the history: {error}"
+        )
+
+
+def recorded(operation):
+    """
+    Decorator recording each call of an API function taking the jail name as its
+    first argument in the history, along with its duration and return code.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(jail_name, *args, **kwargs):
+            started_at = time.time()
+            start_time = time.monotonic()
+            returncode = 1
+            result = None
+            try:
+                result = func(jail_name, *args, **kwargs)
+                returncode = 0
+                return result
+            except JailmakerError as error:
+                returncode = error.returncode
+                raise
+            finally:
+                # Nothing happened when the jail was already started
+                if returncode != 0 or getattr(result, "started", True):
+                    add_history(
+                        jail_name,
+                        operation,
+                        started_at,
+                        time.monotonic() - start_time,
+                        returncode,
+                    )
+
+        return wrapper
+
+    return decorator
+
+
+def percentile(sorted_values, p):
+    """
+    Return the p-th percentile of sorted values, using the nearest-rank method.
+    """
+    return sorted_values[max(0, math.ceil(p / 100 * len(sorted_values)) - 1)]
+
+
+def show_history(jail_name=None, operation=None):
+    """
+    Show the duration percentiles of the operations per jail and flag regressions.
+    """
+    query = "SELECT jail, operation, duration, returncode FROM operations"
+    conditions = []
+    params = []
+    if jail_name:
+        conditions.append("jail = ?")
+        params.append(jail_name)
+    if operation:
+        conditions.append("operation = ?")
+        params.append(operation)
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY started_at"
+
+    if not os.path.exists(HISTORY_DB_PATH):
+        print("No history.")
+        return 0
+
+    with contextlib.closing(connect_history_db()) as db:
+        rows = db.execute(query, params).fetchall()
+
+    durations = defaultdict(list)
+    failures = defaultdict(int)
+    for row_jail_name, row_operation, duration, returncode in rows:
+        if returncode == 0:
+            durations[row_jail_name, row_operation].append(duration)
+        else:
+            failures[row_jail_name, row_operation] += 1
+
+    if not durations and not failures:
+        print("No history.")
         return 0
 
+    table = []
+    for key in sorted(durations.keys() | failures.keys()):
+        row = dict(zip(["name", "operation"], key))
+        row["runs"] = len(durations[key])
+        row["failed"] = failures[key]
+        table.append(row)
+
+        if not durations[key]:
+            continue
+
+        sorted_durations = sorted(durations[key])
+        for p in [50, 90, 99]:
+            row[f"p{p}"] = f"{percentile(sorted_durations, p):.1f}s"
+
+        last = durations[key][-1]
+        row["last"] = f"{last:.1f}s"
+        previous = sorted(durations[key][-HISTORY_BASELINE_RUNS - 1 : -1])
+        if previous:
+            baseline = percentile(previous, 50)
+            row["baseline"] = f"{baseline:.1f}s"
+            if last > baseline * HISTORY_REGRESSION_FACTOR:
+                row["regression"] = f"{RED}{BOLD}{last / baseline:.1f}x slower{NORMAL}"
+
+    print_table(
+        [
+            "name",
+            "operation",
+            "runs",
+            "failed",
+            "p50",
+            "p90",
+            "p99",
+            "last",
+            "baseline",
+            "regression",
+        ],
+        table,
+        "-",
+    )
+
+    return 0
+
+
+@recorded("start")
+def start(jail_name, wait=None, verbose=False):
+    """
+    Start jail with given name and return a StartResult, raise JailmakerError on failure.
+    When wait is given, block until the init system of the jail reports it's ready,
+    but for no longer than wait seconds.
+    Print the progress when verbose.
+    """
+    import tempfile
+    from pathlib import Path
+
+    if jail_is_running(jail_name):
+        return StartResult(jail_name, False, None)
+
     jail_path = get_jail_path(jail_name)
     jail_config_path = get_jail_config_path(jail_name)
     jail_rootfs_path = get_jail_rootfs_path(jail_name)
 
-    config = parse_config_file(jail_config_path)
+    with trace("parse config", jail=jail_name):
+        config = parse_config_file(jail_config_path)
 
     if not config:
-        eprint("Aborting...")
-        return 1
+        raise JailmakerError("Aborting...")
 
     seccomp = config.my_getboolean("seccomp")
 
@@ -621,35 +1764,37 @@ def start_jail(jail_name):
     # Or pull docker images containing device nodes:
     # docker pull oraclelinux@sha256:d49469769e4701925d5145c2676d5a10c38c213802cf13270ec3a12c9c84d643
 
-    # Add hooks to execute commands on the host before/after starting and after stopping a jail
-    add_hook(
-        jail_path,
-        systemd_run_additional_args,
-        config.my_get("pre_start_hook"),
-        "ExecStartPre",
-    )
+    with trace("add hooks", jail=jail_name):
+        # Add hooks to execute commands on the host before/after starting and after stopping a jail
+        add_hook(
+            jail_path,
+            systemd_run_additional_args,
+            config.my_get("pre_start_hook"),
+            "ExecStartPre",
+        )
 
-    add_hook(
-        jail_path,
-        systemd_run_additional_args,
-        config.my_get("post_start_hook"),
-        "ExecStartPost",
-    )
+        add_hook(
+            jail_path,
+            systemd_run_additional_args,
+            config.my_get("post_start_hook"),
+            "ExecStartPost",
+        )
 
-    add_hook(
-        jail_path,
-        systemd_run_additional_args,
-        config.my_get("post_stop_hook"),
-        "ExecStopPost",
-    )
+        add_hook(
+            jail_path,
+            systemd_run_additional_args,
+            config.my_get("post_stop_hook"),
+            "ExecStopPost",
+        )
 
     gpu_passthrough_intel = config.my_getboolean("gpu_passthrough_intel")
     gpu_passthrough_nvidia = config.my_getboolean("gpu_passthrough_nvidia")
 
-    passthrough_intel(gpu_passthrough_intel, systemd_nspawn_additional_args)
-    passthrough_nvidia(
-        gpu_passthrough_nvidia, systemd_nspawn_additional_args, jail_name
-    )
+    with trace("gpu passthrough", jail=jail_name):
+        passthrough_intel(gpu_passthrough_intel, systemd_nspawn_additional_args)
+        passthrough_nvidia(
+            gpu_passthrough_nvidia, systemd_nspawn_additional_args, jail_name
+        )
 
     if seccomp is False:
         # Disabling seccomp filtering by passing --setenv=SYSTEMD_SECCOMP=0 to systemd-run will improve performance
@@ -685,6 +1830,11 @@ def start_jail(jail_name):
         systemd_nspawn_additional_args += [
             "--notify-ready=yes",
         ]
+    elif wait is not None:
+        # With Type=notify systemd-run won't return until the jail init system is ready
+        systemd_nspawn_additional_args += [
+            "--notify-ready=yes",
+        ]
 
     cmd = [
         "systemd-run",
@@ -697,29 +1847,47 @@ def start_jail(jail_name):
         *shlex.split(config.my_get("systemd_nspawn_user_args")),
     ]
 
-    print(
-        dedent(
-            f"""
-        Starting jail {jail_name} with the following command:
+    if verbose:
+        print(
+            dedent(
+                f"""
+            Starting jail {jail_name} with the following command:
 
-        {shlex.join(cmd)}
-    """
+            {shlex.join(cmd)}
+        """
+            )
         )
-    )
 
-    returncode = subprocess.run(cmd).returncode
+    start_time = time.monotonic()
+
+    try:
+        returncode = subprocess.run(
+            cmd,
+            stdout=None if verbose else subprocess.DEVNULL,
+            timeout=None if wait in (None, math.inf) else wait,
+        ).returncode
+    except subprocess.TimeoutExpired:
+        message = f"Jail {jail_name} did not report ready within {wait:g} seconds."
+        if initial_setup:
+            message += "\nThe initial setup has not been run."
+        raise JailmakerError(message)
+
     if returncode != 0:
-        eprint(
+        raise JailmakerError(
             dedent(
                 f"""
             Failed to start jail {jail_name}...
             In case of a config error, you may fix it with:
             {COMMAND_NAME} edit {jail_name}
         """
-            )
+            ),
+            returncode,
         )
 
-        return returncode
+    duration = time.monotonic() - start_time
+
+    if verbose and wait is not None:
+        print(f"Jail {jail_name} is ready after {duration:.1f}s.")
 
     # Handle initial setup after jail is up and running (for the first time)
     if initial_setup:
@@ -739,43 +1907,80 @@ def start_jail(jail_name):
         initial_setup_file_host_path = os.path.abspath(initial_setup_file.name)
         stat_chmod(initial_setup_file_host_path, 0o700)
 
-        print(f"About to run the initial setup script: {initial_setup_file_name}.")
-        print("Waiting for networking in the jail to be ready.")
-        print(
-            "Please wait (this may take 90s in case of bridge networking with STP is enabled)..."
-        )
-        returncode = exec_jail(
+        if verbose:
+            print(f"About to run the initial setup script: {initial_setup_file_name}.")
+            print("Waiting for networking in the jail to be ready.")
+            print(
+                "Please wait (this may take 90s in case of bridge networking with STP is enabled)..."
+            )
+        initial_setup_started_at = time.time()
+        initial_setup_start_time = time.monotonic()
+        with trace("initial setup", jail=jail_name):
+            returncode = exec_jail(
+                jail_name,
+                [
+                    "--",
+                    "systemd-run",
+                    f"--unit={initial_setup_file_name}",
+                    "--quiet",
+                    "--pipe",
+                    "--wait",
+                    "--service-type=exec",
+                    "--property=After=network-online.target",
+                    "--property=Wants=network-online.target",
+                    "/" + initial_setup_file_name,
+                ],
+            )
+
+        add_history(
             jail_name,
-            [
-                "--",
-                "systemd-run",
-                f"--unit={initial_setup_file_name}",
-                "--quiet",
-                "--pipe",
-                "--wait",
-                "--service-type=exec",
-                "--property=After=network-online.target",
-                "--property=Wants=network-online.target",
-                "/" + initial_setup_file_name,
-            ],
+            "initial_setup",
+            initial_setup_started_at,
+            time.monotonic() - initial_setup_start_time,
+            returncode,
         )
 
         if returncode != 0:
-            eprint("Tried to run the following commands inside the jail:")
-            eprint(initial_setup)
-            eprint()
-            eprint(f"{RED}{BOLD}Failed to run initial setup...")
-            eprint(
-                f"You may want to manually run /{initial_setup_file_name} inside the jail for debugging purposes."
+            raise JailmakerError(
+                "\n".join(
+                    [
+                        "Tried to run the following commands inside the jail:",
+                        initial_setup,
+                        "",
+                        f"{RED}{BOLD}Failed to run initial setup...",
+                        f"You may want to manually run /{initial_setup_file_name} inside the jail for debugging purposes.",
+                        f"Or stop and remove the jail and try again.{NORMAL}",
+                    ]
+                ),
+                returncode,
             )
-            eprint(f"Or stop and remove the jail and try again.{NORMAL}")
-            return returncode
-        else:
-            # Cleanup the initial_setup_file_host_path
-            Path(initial_setup_file_host_path).unlink(missing_ok=True)
+
+        # Cleanup the initial_setup_file_host_path
+        Path(initial_setup_file_host_path).unlink(missing_ok=True)
+        if verbose:
             print(f"Done with initial setup of jail {jail_name}!")
 
-    return returncode
+    return StartResult(jail_name, True, duration)
+
+
+def start_jail(jail_name, wait=None):
+    """
+    Start jail with given name.
+    When wait is given, block until the init system of the jail reports it's ready,
+    but for no longer than wait seconds.
+    """
+    try:
+        result = start(jail_name, wait, verbose=True)
+    except JailmakerError as error:
+        eprint(error)
+        return error.returncode
+
+    if not result.started:
+        eprint(
+            f"Skipped starting jail {jail_name}. It appears to be running already..."
+        )
+
+    return 0
 
 
 def restart_jail(jail_name):
@@ -795,6 +2000,7 @@ def cleanup(jail_path):
     """
     Cleanup jail.
     """
+    import shutil
 
     if get_zfs_dataset(jail_path):
         eprint(f"Cleaning up: {jail_path}.")
@@ -821,6 +2027,8 @@ def input_with_default(prompt, default):
     """
     Ask user for input with a default value already provided.
     """
+    import readline
+
     readline.set_startup_hook(lambda: readline.insert_text(default))
     try:
         return input(prompt)
@@ -832,93 +2040,352 @@ def validate_sha256(file_path, digest):
     """
     Validates if a file matches a sha256 digest.
     """
+    import hashlib
+
     try:
         with open(file_path, "rb") as f:
-            file_hash = hashlib.sha256(f.read()).hexdigest()
+            # Hash in chunks, rootfs tarballs don't need to fit in memory
+            file_hash = hashlib.file_digest(f, "sha256").hexdigest()
             return file_hash == digest
     except FileNotFoundError:
         return False
 
 
-def run_lxc_download_script(
-    jail_name=None, jail_path=None, jail_rootfs_path=None, distro=None, release=None
-):
-    arch = "amd64"
-    lxc_dir = ".lxc"
-    lxc_cache = os.path.join(lxc_dir, "cache")
-    lxc_download_script = os.path.join(lxc_dir, "lxc-download.sh")
+def get_image_object_path(digest):
+    return os.path.join(IMAGE_STORE_PATH, "objects", "sha256", digest)
 
-    # Create the lxc dirs if nonexistent
-    os.makedirs(lxc_dir, exist_ok=True)
-    stat_chmod(lxc_dir, 0o700)
-    os.makedirs(lxc_cache, exist_ok=True)
-    stat_chmod(lxc_cache, 0o700)
 
-    try:
-        if os.stat(lxc_download_script).st_uid != 0:
-            os.remove(lxc_download_script)
-    except FileNotFoundError:
-        pass
+def is_valid_image_name(distro, release):
+    return all(re.match(r"^\w[\w.-]*$", x or "") for x in [distro, release])
 
-    # Fetch the lxc download script if not present locally (or hash doesn't match)
-    if not validate_sha256(lxc_download_script, DOWNLOAD_SCRIPT_DIGEST):
-        urllib.request.urlretrieve(
-            "https://raw.githubusercontent.com/Jip-Hop/lxc/b24d2d45b3875b013131b480e61c93b6fb8ea70c/templates/lxc-download.in",
-            lxc_download_script,
-        )
 
-        if not validate_sha256(lxc_download_script, DOWNLOAD_SCRIPT_DIGEST):
-            eprint("Abort! Downloaded script has unexpected contents.")
-            return 1
+def get_image_ref_path(distro, release):
+    return os.path.join(IMAGE_STORE_PATH, "refs", distro, release, f"{IMAGE_ARCH}.json")
 
-    stat_chmod(lxc_download_script, 0o700)
 
-    if None not in [jail_name, jail_path, jail_rootfs_path, distro, release]:
-        cmd = [
-            lxc_download_script,
-            f"--name={jail_name}",
-            f"--path={jail_path}",
-            f"--rootfs={jail_rootfs_path}",
-            f"--arch={arch}",
-            f"--dist={distro}",
-            f"--release={release}",
-        ]
+def store_image_object(fp):
+    """
+    Copy a file object into the image store and return its sha256 digest.
+    """
+    import hashlib
+    import shutil
+    import tempfile
 
-        if rc := subprocess.run(cmd, env={"LXC_CACHE_PATH": lxc_cache}).returncode != 0:
-            eprint("Aborting...")
-            return rc
+    objects_dir = os.path.dirname(get_image_object_path(""))
+    os.makedirs(objects_dir, exist_ok=True)
 
-    else:
-        # List images
-        cmd = [lxc_download_script, "--list", f"--arch={arch}"]
+    sha256 = hashlib.sha256()
+    with tempfile.NamedTemporaryFile(dir=objects_dir, prefix=".", delete=False) as f:
+        try:
+            while chunk := fp.read(shutil.COPY_BUFSIZE):
+                sha256.update(chunk)
+                f.write(chunk)
+        except BaseException:
+            os.remove(f.name)
+            raise
 
-        p1 = subprocess.Popen(
-            cmd, stdout=subprocess.PIPE, env={"LXC_CACHE_PATH": lxc_cache}
-        )
+    digest = sha256.hexdigest()
+    # Content addressed, so whoever stored the same digest first stored the same bytes
+    os.replace(f.name, get_image_object_path(digest))
+    return digest
 
-        for line in iter(p1.stdout.readline, b""):
-            line = line.decode().strip()
-            # Filter out the known incompatible distros
-            if not re.match(
-                r"^(alpine|amazonlinux|busybox|devuan|funtoo|openwrt|plamo|voidlinux)\s",
-                line,
-            ):
-                print(line)
 
-        return p1.wait()
+def read_image_ref(distro, release):
+    """
+    Return the image of distro release in the image store, or None if it hasn't been fetched.
+    """
+    import json
 
-    return 0
+    if not is_valid_image_name(distro, release):
+        return None
 
+    try:
+        with open(get_image_ref_path(distro, release)) as f:
+            image = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
 
-def stat_chmod(file_path, mode):
+    if not os.path.exists(get_image_object_path(image["rootfs"])):
+        return None
+
+    return image
+
+
+def write_image_ref(image):
+    import json
+
+    ref_path = get_image_ref_path(image["distro"], image["release"])
+    os.makedirs(os.path.dirname(ref_path), exist_ok=True)
+    with open(f"{ref_path}.{os.getpid()}", "w") as f:
+        json.dump(image, f, indent=2)
+    os.replace(f.name, ref_path)
+
+
+def get_image_index():
     """
-    Change mode if file doesn't already have this mode.
+    Return the images on the image server as dicts with distro, release, arch, variant, build and path.
     """
-    if mode != stat.S_IMODE(os.stat(file_path).st_mode):
-        os.chmod(file_path, mode)
+    import urllib.request
+
+    with urllib.request.urlopen(
+        f"{IMAGE_SERVER_URL}/meta/1.0/index-system"
+    ) as response:
+        lines = response.read().decode().splitlines()
+
+    keys = ["distro", "release", "arch", "variant", "build", "path"]
+    return [
+        dict(zip(keys, fields))
+        for line in lines
+        if len(fields := line.split(";")) == len(keys)
+    ]
 
 
-def agree(question, default=None):
+def download_image(entry):
+    """
+    Download the rootfs of an image index entry into the image store and return the image.
+    """
+    import tarfile
+    import urllib.request
+
+    url = f"{IMAGE_SERVER_URL}/{entry['path'].strip('/')}"
+
+    # The metadata lists the files in the rootfs which mention the name of the container
+    with urllib.request.urlopen(f"{url}/meta.tar.xz") as response:
+        with tarfile.open(fileobj=response, mode="r|xz") as meta:
+            templates = []
+            for member in meta:
+                if member.name.lstrip("./") == "templates":
+                    templates = meta.extractfile(member).read().decode().split()
+
+    with urllib.request.urlopen(f"{url}/rootfs.tar.xz") as response:
+        digest = store_image_object(response)
+
+    return {
+        "distro": entry["distro"],
+        "release": entry["release"],
+        "arch": entry["arch"],
+        "variant": entry["variant"],
+        "build": entry["build"],
+        "rootfs": digest,
+        "templates": templates,
+        "fetched_at": time.time(),
+    }
+
+
+def fetch_image(distro, release, update=False):
+    """
+    Return the image of distro release from the image store, downloading it when it isn't there.
+    Check the image server for a newer build when update. Raise JailmakerError on failure.
+    """
+    import urllib.error
+
+    if not is_valid_image_name(distro, release):
+        raise JailmakerError(f"Invalid distro or release: {distro} {release}.")
+
+    # Only one create should download a missing image
+    with runtime_lock(f"image-{distro}-{release}"):
+        image = read_image_ref(distro, release)
+        if image and not update:
+            return image
+
+        try:
+            entry = next(
+                (
+                    x
+                    for x in get_image_index()
+                    if (x["distro"], x["release"], x["arch"], x["variant"])
+                    == (distro, release, IMAGE_ARCH, IMAGE_VARIANT)
+                ),
+                None,
+            )
+            if entry is None:
+                raise JailmakerError(f"There's no {distro} {release} image.")
+
+            if image and image["build"] == entry["build"]:
+                return image
+
+            eprint(f"Downloading {distro} {release} build {entry['build']}.")
+            image = download_image(entry)
+        except (urllib.error.URLError, OSError) as error:
+            if image:
+                eprint(f"Using the stored {distro} {release} image, {error}.")
+                return image
+            raise JailmakerError(f"Failed to download {distro} {release}: {error}.")
+
+        write_image_ref(image)
+        return image
+
+
+def extract_image(image, jail_rootfs_path):
+    """
+    Verify the rootfs tarball of an image in the image store and extract it into jail_rootfs_path.
+    Raise JailmakerError on failure.
+    """
+    object_path = get_image_object_path(image["rootfs"])
+
+    if not validate_sha256(object_path, image["rootfs"]):
+        # Fetch the image again next time
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(object_path)
+        raise JailmakerError(
+            f"The stored {image['distro']} {image['release']} image is corrupted."
+        )
+
+    os.makedirs(jail_rootfs_path, exist_ok=True)
+    returncode = subprocess.run(
+        ["tar", "--numeric-owner", "-xpJf", object_path, "-C", jail_rootfs_path]
+    ).returncode
+    if returncode != 0:
+        raise JailmakerError(
+            f"Failed to extract {image['distro']} {image['release']}.", returncode
+        )
+
+
+def get_image_placeholders(jail_name):
+    """
+    Return the placeholders in the templates of an image and their values for a jail.
+    """
+    jail_path = get_jail_path(jail_name)
+    return [
+        ("LXC_ROOTFS", os.path.join(jail_path, JAIL_ROOTFS_NAME)),
+        ("LXC_PATH", jail_path),
+        ("LXC_NAME", jail_name),
+    ]
+
+
+def replace_in_image_templates(image, jail_name, replacements):
+    """
+    Make the (old, new) replacements in the files of the rootfs of a jail the image marks as templates.
+    """
+    jail_rootfs_path = get_jail_rootfs_path(jail_name)
+    for template in image["templates"]:
+        try:
+            fd = open_in_root(jail_rootfs_path, template, os.O_RDWR)
+        except OSError:
+            continue
+
+        with open(fd, "r+") as f:
+            text = f.read()
+            for old, new in replacements:
+                text = text.replace(old, new)
+            f.seek(0)
+            f.write(text)
+            f.truncate()
+
+
+def apply_image_templates(image, jail_name):
+    """
+    Fill in the name of the jail in the files of its rootfs the image marks as templates.
+    """
+    replace_in_image_templates(image, jail_name, get_image_placeholders(jail_name))
+
+
+def list_images(prefetch=None):
+    """
+    List the images to create jails from, or fetch the (distro, release) images in prefetch
+    into the image store so jails can be created from them without network access.
+    """
+    if not prefetch:
+        return run_lxc_download_script()
+
+    returncode = 0
+    for distro, release in prefetch:
+        try:
+            image = fetch_image(distro, release, update=True)
+        except JailmakerError as error:
+            eprint(error)
+            returncode = error.returncode
+            continue
+
+        print(
+            f"{distro} {release} build {image['build']} is stored as {image['rootfs']}."
+        )
+
+    return returncode
+
+
+def run_lxc_download_script(
+    jail_name=None, jail_path=None, jail_rootfs_path=None, distro=None, release=None
+):
+    import urllib.request
+
+    arch = IMAGE_ARCH
+    lxc_dir = ".lxc"
+    lxc_cache = os.path.join(lxc_dir, "cache")
+    lxc_download_script = os.path.join(lxc_dir, "lxc-download.sh")
+
+    # Create the lxc dirs if nonexistent
+    os.makedirs(lxc_dir, exist_ok=True)
+    stat_chmod(lxc_dir, 0o700)
+    os.makedirs(lxc_cache, exist_ok=True)
+    stat_chmod(lxc_cache, 0o700)
+
+    try:
+        if os.stat(lxc_download_script).st_uid != 0:
+            os.remove(lxc_download_script)
+    except FileNotFoundError:
+        pass
+
+    # Fetch the lxc download script if not present locally (or hash doesn't match)
+    with runtime_lock("lxc-download-script"):
+        if not validate_sha256(lxc_download_script, DOWNLOAD_SCRIPT_DIGEST):
+            urllib.request.urlretrieve(
+                "https://raw.githubusercontent.com/Jip-Hop/lxc/b24d2d45b3875b013131b480e61c93b6fb8ea70c/templates/lxc-download.in",
+                lxc_download_script,
+            )
+
+            if not validate_sha256(lxc_download_script, DOWNLOAD_SCRIPT_DIGEST):
+                eprint("Abort! Downloaded script has unexpected contents.")
+                return 1
+
+    stat_chmod(lxc_download_script, 0o700)
+
+    if None not in [jail_name, jail_path, jail_rootfs_path, distro, release]:
+        cmd = [
+            lxc_download_script,
+            f"--name={jail_name}",
+            f"--path={jail_path}",
+            f"--rootfs={jail_rootfs_path}",
+            f"--arch={arch}",
+            f"--dist={distro}",
+            f"--release={release}",
+        ]
+
+        if rc := subprocess.run(cmd, env={"LXC_CACHE_PATH": lxc_cache}).returncode != 0:
+            eprint("Aborting...")
+            return rc
+
+    else:
+        # List images
+        cmd = [lxc_download_script, "--list", f"--arch={arch}"]
+
+        p1 = subprocess.Popen(
+            cmd, stdout=subprocess.PIPE, env={"LXC_CACHE_PATH": lxc_cache}
+        )
+
+        for line in iter(p1.stdout.readline, b""):
+            line = line.decode().strip()
+            # Filter out the known incompatible distros
+            if not re.match(
+                r"^(alpine|amazonlinux|busybox|devuan|funtoo|openwrt|plamo|voidlinux)\s",
+                line,
+            ):
+                print(line)
+
+        return p1.wait()
+
+    return 0
+
+
+def stat_chmod(file_path, mode):
+    """
+    Change mode if file doesn't already have this mode.
+    """
+    if mode != stat.S_IMODE(os.stat(file_path).st_mode):
+        os.chmod(file_path, mode)
+
+
+def agree(question, default=None):
     """
     Ask user a yes/no question.
     """
@@ -944,6 +2411,8 @@ def get_mount_point(path):
 
 
 def get_relative_path_in_jailmaker_dir(absolute_path):
+    from pathlib import PurePath
+
     return PurePath(absolute_path).relative_to(SCRIPT_DIR_PATH)
 
 
@@ -971,18 +2440,25 @@ def get_zfs_base_path():
     """
     zfs_base_path = get_zfs_dataset(SCRIPT_DIR_PATH)
     if not zfs_base_path:
-        fail("Failed to get dataset path for jailmaker directory.")
+        raise JailmakerError("Failed to get dataset path for jailmaker directory.")
 
     return zfs_base_path
 
 
+def get_zfs_dataset_name(absolute_path):
+    """
+    Return the name of the ZFS Dataset inside the jailmaker directory at the provided absolute path.
+    """
+    relative_path = get_relative_path_in_jailmaker_dir(absolute_path)
+    return os.path.join(get_zfs_base_path(), relative_path)
+
+
 def create_zfs_dataset(absolute_path):
     """
     Create a ZFS Dataset inside the jailmaker directory at the provided absolute path.
     E.g. "/mnt/mypool/jailmaker/jails" or "/mnt/mypool/jailmaker/jails/newjail").
     """
-    relative_path = get_relative_path_in_jailmaker_dir(absolute_path)
-    dataset_to_create = os.path.join(get_zfs_base_path(), relative_path)
+    dataset_to_create = get_zfs_dataset_name(absolute_path)
     eprint(f"Creating ZFS Dataset {dataset_to_create}")
     subprocess.run(["zfs", "create", dataset_to_create], check=True)
 
@@ -992,12 +2468,159 @@ def remove_zfs_dataset(absolute_path):
     Remove a ZFS Dataset inside the jailmaker directory at the provided absolute path.
     E.g. "/mnt/mypool/jailmaker/jails/oldjail".
     """
-    relative_path = get_relative_path_in_jailmaker_dir(absolute_path)
-    dataset_to_remove = os.path.join((get_zfs_base_path()), relative_path)
+    dataset_to_remove = get_zfs_dataset_name(absolute_path)
     eprint(f"Removing ZFS Dataset {dataset_to_remove}")
     subprocess.run(["zfs", "destroy", "-r", dataset_to_remove], check=True)
 
 
+@contextlib.contextmanager
+def runtime_lock(name):
+    """
+    Hold an exclusive lock with given name, shared by all threads and processes.
+    """
+    import fcntl
+
+    os.makedirs(RUNTIME_DIR_PATH, mode=0o700, exist_ok=True)
+    lock_path = os.path.join(RUNTIME_DIR_PATH, f"{name.replace(os.sep, '_')}.lock")
+    with open(lock_path, "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def create_jails_dir():
+    """
+    Create the directory where to store the jails, as a dataset if the jailmaker directory is a dataset.
+    """
+    if os.path.exists(JAILS_DIR_PATH):
+        return
+
+    with runtime_lock("jails-dir"):
+        if not os.path.exists(JAILS_DIR_PATH):
+            if get_zfs_dataset(SCRIPT_DIR_PATH):
+                # Creating "jails" dataset if "jailmaker" is a ZFS Dataset
+                create_zfs_dataset(JAILS_DIR_PATH)
+            else:
+                os.makedirs(JAILS_DIR_PATH, exist_ok=True)
+            stat_chmod(JAILS_DIR_PATH, 0o700)
+
+
+def get_image_path(image_name):
+    return os.path.join(IMAGES_DIR_PATH, image_name)
+
+
+def get_golden_image_path(distro, release):
+    return get_image_path(f"{distro}-{release}")
+
+
+def create_images_dir():
+    """
+    Create the images directory, as a dataset if the jails directory is a dataset.
+    """
+    if os.path.exists(IMAGES_DIR_PATH):
+        return
+
+    with runtime_lock("images-dir"):
+        if not os.path.exists(IMAGES_DIR_PATH):
+            if get_zfs_dataset(JAILS_DIR_PATH):
+                create_zfs_dataset(IMAGES_DIR_PATH)
+            else:
+                os.makedirs(IMAGES_DIR_PATH, exist_ok=True)
+            stat_chmod(IMAGES_DIR_PATH, 0o700)
+
+
+def zfs_snapshot_exists(snapshot):
+    return (
+        subprocess.run(
+            ["zfs", "list", "-H", "-t", "snapshot", "-o", "name", snapshot],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        ).returncode
+        == 0
+    )
+
+
+def create_golden_image(image):
+    """
+    Extract the rootfs of an image from the image store into a new dataset in the images directory,
+    then snapshot it and make it read-only so it stays pristine.
+    """
+    distro, release = image["distro"], image["release"]
+    image_path = get_golden_image_path(distro, release)
+
+    create_images_dir()
+
+    # Start over in case a previous attempt was interrupted before the snapshot
+    if get_zfs_dataset(image_path):
+        remove_zfs_dataset(image_path)
+
+    create_zfs_dataset(image_path)
+
+    try:
+        # Templates are filled in on the clones, the golden image is the same for all jails
+        with trace("extract rootfs", distro=distro, release=release):
+            extract_image(image, os.path.join(image_path, JAIL_ROOTFS_NAME))
+    except BaseException:
+        remove_zfs_dataset(image_path)
+        raise
+
+    snapshot_image(image_path)
+
+
+def snapshot_image(image_path):
+    """
+    Snapshot the dataset of an image to clone jails from and make it read-only.
+    """
+    image_dataset = get_zfs_dataset_name(image_path)
+    subprocess.run(
+        ["zfs", "snapshot", f"{image_dataset}@{GOLDEN_SNAPSHOT_NAME}"], check=True
+    )
+    subprocess.run(["zfs", "set", "readonly=on", image_dataset], check=True)
+
+
+def clone_image(jail_path, image_path):
+    """
+    Create the dataset of a jail as a ZFS clone of the snapshot of an image.
+    Copy the rootfs of the image into the jail directory if the image isn't a dataset.
+    """
+    if not get_zfs_dataset(image_path):
+        os.makedirs(jail_path, exist_ok=True)
+        eprint(f"Copying rootfs of image {os.path.basename(image_path)}.")
+        subprocess.run(
+            [
+                "cp",
+                "--archive",
+                "--reflink=auto",
+                os.path.join(image_path, JAIL_ROOTFS_NAME),
+                os.path.join(jail_path, JAIL_ROOTFS_NAME),
+            ],
+            check=True,
+        )
+        return
+
+    snapshot = f"{get_zfs_dataset_name(image_path)}@{GOLDEN_SNAPSHOT_NAME}"
+    dataset_to_create = get_zfs_dataset_name(jail_path)
+    eprint(f"Cloning ZFS Dataset {dataset_to_create} from {snapshot}")
+    subprocess.run(["zfs", "clone", snapshot, dataset_to_create], check=True)
+
+
+def clone_golden_image(jail_path, image):
+    """
+    Create the dataset of a jail as a ZFS clone of the golden image of an image from the image store,
+    which is created first if there's none yet.
+    """
+    distro, release = image["distro"], image["release"]
+    image_path = get_golden_image_path(distro, release)
+    snapshot = f"{get_zfs_dataset_name(image_path)}@{GOLDEN_SNAPSHOT_NAME}"
+
+    # Only one create should make a missing golden image
+    with runtime_lock(f"golden-image-{distro}-{release}"):
+        if not zfs_snapshot_exists(snapshot):
+            eprint(f"Creating golden image of {distro} {release}.")
+            create_golden_image(image)
+
+    clone_image(jail_path, image_path)
+
+
 def check_jail_name_valid(jail_name, warn=True):
     """
     Return True if jail name matches the required format.
@@ -1053,6 +2676,8 @@ def agree_with_default(config, key, question):
 
 
 def get_text_editor():
+    import shutil
+
     def get_from_environ(key):
         if editor := os.environ.get(key):
             return shutil.which(editor)
@@ -1067,7 +2692,10 @@ def get_text_editor():
 
 
 def interactive_config():
-    config = KeyValueParser()
+    import platform
+    import tempfile
+
+    config = new_key_value_parser()
     config.read_string(DEFAULT_CONFIG)
 
     recommended_distro = config.my_get("distro")
@@ -1097,7 +2725,7 @@ def interactive_config():
             subprocess.call([get_text_editor(), f.name])
             f.seek(0)
             # Start over with a new KeyValueParser to parse user config
-            config = KeyValueParser()
+            config = new_key_value_parser()
             config.read_file(f)
 
         # Ask for jail name
@@ -1236,11 +2864,12 @@ def interactive_config():
     return jail_name, config, start_now
 
 
-def create_jail(**kwargs):
-    print(DISCLAIMER)
-
+def check_script_dir_safe():
+    """
+    Raise JailmakerError if it's not safe to create jails next to this script.
+    """
     if os.path.basename(SCRIPT_DIR_PATH) != "jailmaker":
-        eprint(
+        raise JailmakerError(
             dedent(
                 f"""
             {COMMAND_NAME} needs to create files.
@@ -1249,7 +2878,18 @@ def create_jail(**kwargs):
             Please create a dedicated dataset called "jailmaker", store {SCRIPT_NAME} there and try again."""
             )
         )
-        return 1
+
+
+def create_jail(**kwargs):
+    from pathlib import PurePath
+
+    print(DISCLAIMER)
+
+    try:
+        check_script_dir_safe()
+    except JailmakerError as error:
+        eprint(error)
+        return error.returncode
 
     if not PurePath(get_mount_point(SCRIPT_DIR_PATH)).is_relative_to("/mnt"):
         print(
@@ -1268,6 +2908,15 @@ def create_jail(**kwargs):
     jail_name = kwargs.pop("jail_name", None)
     start_now = False
 
+    if manifest_path := kwargs.pop("manifest", None):
+        if jail_name:
+            eprint("Either pass a jail name or a manifest, not both.")
+            return 1
+
+        return create_manifest_jails(
+            manifest_path, kwargs.pop("jobs"), kwargs.pop("start")
+        )
+
     # Non-interactive create
     if jail_name:
         if not check_jail_name_valid(jail_name):
@@ -1278,26 +2927,31 @@ def create_jail(**kwargs):
 
         start_now = kwargs.pop("start", start_now)
         jail_config_path = kwargs.pop("config")
+        image_name = kwargs.pop("from_image")
 
-        config = KeyValueParser()
-
-        if jail_config_path:
-            # TODO: fallback to default values for e.g. distro and release if they are not in the config file
-            if jail_config_path == "-":
-                print(
-                    f"Creating jail {jail_name} from config template passed via stdin."
-                )
-                config.read_string(sys.stdin.read())
-            else:
-                print(
-                    f"Creating jail {jail_name} from config template {jail_config_path}."
-                )
-                if jail_config_path not in config.read(jail_config_path):
-                    eprint(f"Failed to read config template {jail_config_path}.")
-                    return 1
+        if not jail_config_path and image_name:
+            print(f"Creating jail {jail_name} from image {image_name}.")
+            jail_config_path = os.path.join(
+                get_image_path(image_name), JAIL_CONFIG_NAME
+            )
+            if not check_jail_name_valid(image_name, False) or not os.path.isfile(
+                jail_config_path
+            ):
+                eprint(f"There's no image with name {image_name}.")
+                return 1
+        elif jail_config_path == "-":
+            print(f"Creating jail {jail_name} from config template passed via stdin.")
+        elif jail_config_path:
+            print(f"Creating jail {jail_name} from config template {jail_config_path}.")
         else:
             print(f"Creating jail {jail_name} with default config.")
-            config.read_string(DEFAULT_CONFIG)
+
+        try:
+            # TODO: fallback to default values for e.g. distro and release if they are not in the config file
+            config = read_config_template(jail_config_path)
+        except JailmakerError as error:
+            eprint(error)
+            return error.returncode
 
         user_overridden = False
 
@@ -1333,47 +2987,112 @@ def create_jail(**kwargs):
                   """
                 )
             )
+    elif kwargs.get("from_image"):
+        eprint("Creating a jail from an image requires a jail name.")
+        return 1
     else:
         jail_name, config, start_now = interactive_config()
+        image_name = None
 
-    jail_path = get_jail_path(jail_name)
+    try:
+        create(jail_name, config, start_now, image_name, verbose=True)
+    except JailmakerError as error:
+        eprint(error)
+        return error.returncode
 
-    distro = config.my_get("distro")
-    release = config.my_get("release")
+    return 0
 
-    # Cleanup in except, but only once the jail_path is final
-    # Otherwise we may cleanup the wrong directory
-    try:
-        # Create the dir or dataset where to store the jails
-        if not os.path.exists(JAILS_DIR_PATH):
-            if get_zfs_dataset(SCRIPT_DIR_PATH):
-                # Creating "jails" dataset if "jailmaker" is a ZFS Dataset
-                create_zfs_dataset(JAILS_DIR_PATH)
-            else:
-                os.makedirs(JAILS_DIR_PATH, exist_ok=True)
-            stat_chmod(JAILS_DIR_PATH, 0o700)
 
-        # Creating a dataset for the jail if the jails dir is a dataset
-        if get_zfs_dataset(JAILS_DIR_PATH):
-            create_zfs_dataset(jail_path)
+def read_config_template(config_path=None):
+    """
+    Return a KeyValueParser with the config template at config_path, - for stdin.
+    Return the default config if there's no config_path.
+    """
+    config = new_key_value_parser()
+
+    if not config_path:
+        config.read_string(DEFAULT_CONFIG)
+    elif config_path == "-":
+        config.read_string(sys.stdin.read())
+    elif config_path not in config.read(config_path):
+        raise JailmakerError(f"Failed to read config template {config_path}.")
+
+    return config
+
+
+def remove_machine_specific_files(jail_rootfs_path):
+    """
+    Remove config which systemd handles for us on the first boot of a jail.
+    """
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(os.path.join(jail_rootfs_path, "etc/machine-id"))
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(os.path.join(jail_rootfs_path, "etc/resolv.conf"))
+
+
+@recorded("create")
+def create(jail_name, config, start_now=False, image_name=None, verbose=False):
+    """
+    Create a jail with given name from a KeyValueParser config and return its JailInfo.
+    Raise JailmakerError on failure. Start the jail afterwards when start_now.
+    Copy the rootfs of the baked image with image_name instead of downloading it.
+    Print the progress and warnings when verbose.
+    """
+    from inspect import cleandoc
+    from pathlib import Path
+
+    check_script_dir_safe()
+
+    if not check_jail_name_valid(jail_name, verbose):
+        raise JailmakerError(f"Invalid jail name: {jail_name}.")
+
+    if not check_jail_name_available(jail_name, verbose):
+        raise JailmakerError(f"A jail with name {jail_name} already exists.")
+
+    jail_path = get_jail_path(jail_name)
+
+    distro = config.my_get("distro")
+    release = config.my_get("release")
+
+    if image_name is not None:
+        image_path = get_image_path(image_name)
+        if not check_jail_name_valid(image_name, verbose) or not os.path.isfile(
+            os.path.join(image_path, JAIL_CONFIG_NAME)
+        ):
+            raise JailmakerError(f"There's no image with name {image_name}.")
+        # The image has already been set up
+        config.my_set("initial_setup", "")
+
+    # Cleanup in except, but only once the jail_path is final
+    # Otherwise we may cleanup the wrong directory
+    try:
+        create_jails_dir()
 
         jail_config_path = get_jail_config_path(jail_name)
         jail_rootfs_path = get_jail_rootfs_path(jail_name)
 
-        # Create directory for rootfs
-        os.makedirs(jail_rootfs_path, exist_ok=True)
-        # LXC download script needs to write to this file during install
-        # but we don't need it so we will remove it later
-        open(jail_config_path, "a").close()
+        if image_name is not None:
+            with trace("clone image", image=image_name):
+                clone_image(jail_path, image_path)
 
-        if (
-            returncode := run_lxc_download_script(
-                jail_name, jail_path, jail_rootfs_path, distro, release
-            )
-            != 0
-        ):
-            cleanup(jail_path)
-            return returncode
+            # Baked images have their templates turned back into placeholders
+            if image := read_image_ref(distro, release):
+                apply_image_templates(image, jail_name)
+        else:
+            # Only downloads the image if it's not in the image store yet
+            with trace("fetch image", distro=distro, release=release):
+                image = fetch_image(distro, release)
+
+            if get_zfs_dataset(JAILS_DIR_PATH):
+                # Clone the dataset for the jail from a pristine rootfs of the distro,
+                # which takes seconds and hardly any space compared to extracting it
+                with trace("clone golden image", distro=distro, release=release):
+                    clone_golden_image(jail_path, image)
+            else:
+                with trace("extract rootfs", distro=distro, release=release):
+                    extract_image(image, jail_rootfs_path)
+
+            apply_image_templates(image, jail_name)
 
         # Assuming the name of your jail is "myjail"
         # and "machinectl shell myjail" doesn't work
@@ -1398,17 +3117,22 @@ def create_jail(**kwargs):
         # But alpine jails made with jailmaker have other issues
         # They don't shutdown cleanly via systemctl and machinectl...
 
-        with Chroot(jail_rootfs_path):
-            # Use chroot to correctly resolve absolute /sbin/init symlink
-            init_system_name = os.path.basename(os.path.realpath("/sbin/init"))
+        try:
+            # Resolve the (absolute) /sbin/init symlink inside the rootfs
+            init_system_name = os.path.basename(
+                resolve_in_root(jail_rootfs_path, "/sbin/init")
+            )
+        except OSError:
+            init_system_name = None
 
         if (
             init_system_name != "systemd"
             and parse_os_release(jail_rootfs_path).get("ID") != "nixos"
         ):
-            print(
-                dedent(
-                    f"""
+            if verbose:
+                print(
+                    dedent(
+                        f"""
                 {YELLOW}{BOLD}WARNING: DISTRO NOT SUPPORTED{NORMAL}
 
                 Chosen distro appears not to use systemd...
@@ -1424,19 +3148,15 @@ def create_jail(**kwargs):
 
                 {BOLD}Using this distro with {COMMAND_NAME} is NOT recommended.{NORMAL}
             """
+                    )
                 )
-            )
 
-            print("Autostart has been disabled.")
-            print("You need to start this jail manually.")
+                print("Autostart has been disabled.")
+                print("You need to start this jail manually.")
             config.my_set("startup", 0)
             start_now = False
 
-        # Remove config which systemd handles for us
-        with contextlib.suppress(FileNotFoundError):
-            os.remove(os.path.join(jail_rootfs_path, "etc/machine-id"))
-        with contextlib.suppress(FileNotFoundError):
-            os.remove(os.path.join(jail_rootfs_path, "etc/resolv.conf"))
+        remove_machine_specific_files(jail_rootfs_path)
 
         # https://github.com/systemd/systemd/issues/852
         print(
@@ -1535,19 +3255,332 @@ def create_jail(**kwargs):
         raise error
 
     if start_now:
-        return start_jail(jail_name)
+        with trace("start", jail=jail_name):
+            start(jail_name, verbose=verbose)
+
+    return get_jail(jail_name)
+
+
+def bake(image_name, config, verbose=False):
+    """
+    Create a temporary jail from a KeyValueParser config, run its initial_setup once
+    and store the result as an image with given name to create jails from.
+    Raise JailmakerError on failure. Print the progress when verbose.
+    """
+    if not check_jail_name_valid(image_name, verbose):
+        raise JailmakerError(f"Invalid image name: {image_name}.")
+
+    image_path = get_image_path(image_name)
+    if os.path.exists(image_path):
+        raise JailmakerError(f"An image with name {image_name} already exists.")
+
+    if not config.my_get("initial_setup"):
+        raise JailmakerError("There's no initial_setup in the config to bake.")
+
+    jail_name = f"bake-{image_name}"
+    jail_path = get_jail_path(jail_name)
+    config.my_set("startup", 0)
+
+    with trace("create", jail=jail_name):
+        create(jail_name, config, verbose=verbose)
+
+    try:
+        # Starting for the first time runs the initial_setup
+        with trace("start", jail=jail_name):
+            start(jail_name, verbose=verbose)
+        with trace("stop", jail=jail_name):
+            stop([jail_name], verbose=verbose)
+
+        remove_machine_specific_files(get_jail_rootfs_path(jail_name))
+
+        # Don't let jails created from the image inherit the name of the temporary jail
+        if image := read_image_ref(config.my_get("distro"), config.my_get("release")):
+            replace_in_image_templates(
+                image,
+                jail_name,
+                [
+                    (value, placeholder)
+                    for placeholder, value in get_image_placeholders(jail_name)
+                ],
+            )
+
+        # Jails created from the image have already been set up
+        config.my_set("initial_setup", "")
+        jail_config_path = get_jail_config_path(jail_name)
+        with open(jail_config_path, "w") as fp:
+            config.write(fp)
+
+        create_images_dir()
+        if get_zfs_dataset(jail_path):
+            subprocess.run(
+                [
+                    "zfs",
+                    "rename",
+                    get_zfs_dataset_name(jail_path),
+                    get_zfs_dataset_name(image_path),
+                ],
+                check=True,
+            )
+            snapshot_image(image_path)
+        else:
+            os.rename(jail_path, image_path)
+
+    # Cleanup the temporary jail on any exception and rethrow
+    except BaseException as error:
+        with contextlib.suppress(JailmakerError):
+            stop([jail_name])
+        cleanup(jail_path)
+        raise error
+
+    if verbose:
+        print(f"Baked image {image_name}.")
+        print(
+            f"Create jails from it with: {COMMAND_NAME} create --from-image {image_name} NAME"
+        )
+
+
+def bake_image(image_name, config):
+    """
+    Bake an image with given name from the config template at path config.
+    """
+    try:
+        check_script_dir_safe()
+        bake(image_name, read_config_template(config), verbose=True)
+    except JailmakerError as error:
+        eprint(error)
+        return error.returncode
+
+    return 0
+
+
+def read_manifest(manifest_path):
+    """
+    Return the name, config and image name of each jail in an INI manifest file.
+    Each section is a jail, with the path to its config template in the config key
+    (relative to the manifest) or the name of an image in the from_image key.
+    The other keys override the values of the config. The [DEFAULT] section applies to all jails.
+    Raise JailmakerError if the manifest, or any jail in it, isn't valid.
+    """
+    import configparser
+
+    manifest = configparser.ConfigParser(interpolation=None)
+    try:
+        if manifest_path == "-":
+            manifest.read_string(sys.stdin.read(), "<stdin>")
+        elif manifest_path not in manifest.read(manifest_path):
+            raise JailmakerError(f"Failed to read manifest {manifest_path}.")
+    except configparser.Error as error:
+        raise JailmakerError(f"Failed to parse manifest {manifest_path}: {error}")
+
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_path))
+    jails = []
+    errors = []
+    for jail_name in manifest.sections():
+        overrides = dict(manifest[jail_name])
+        config_path = overrides.pop("config", None)
+        image_name = overrides.pop("from_image", None)
+
+        if not check_jail_name_valid(jail_name, False):
+            errors.append(f"Invalid jail name: {jail_name}.")
+            continue
+        if not check_jail_name_available(jail_name, False):
+            errors.append(f"A jail with name {jail_name} already exists.")
+            continue
+
+        if image_name and not config_path:
+            config_path = os.path.join(get_image_path(image_name), JAIL_CONFIG_NAME)
+        elif config_path:
+            config_path = os.path.join(manifest_dir, config_path)
+
+        try:
+            config = read_config_template(config_path)
+        except JailmakerError as error:
+            errors.append(f"Jail {jail_name}: {error}")
+            continue
+
+        for option, value in overrides.items():
+            config.my_set(option, value)
+
+        jails.append((jail_name, config, image_name))
+
+    if errors:
+        raise JailmakerError("\n".join(errors))
+
+    if not jails:
+        raise JailmakerError(f"There are no jails in manifest {manifest_path}.")
+
+    return jails
+
+
+def create_many(jails, jobs=1, start_now=False, on_done=None):
+    """
+    Create jails from (name, config, image name) tuples, at most jobs at the same time.
+    Return a dict with the JailInfo, or the JailmakerError, of each jail name.
+    Only the jails which fail are cleaned up. Call on_done with the name and result
+    of each jail as soon as it's done.
+    """
+    import concurrent.futures
+
+    # Create once, before jails race for it
+    create_jails_dir()
+
+    def create_one(jail_name, config, image_name):
+        try:
+            return create(jail_name, config, start_now, image_name)
+        except JailmakerError as error:
+            return error
+        except Exception as error:
+            return JailmakerError(f"{type(error).__name__}: {error}")
+
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=max(1, min(jobs, MAX_JOBS))
+    ) as executor:
+        futures = {executor.submit(create_one, *jail): jail[0] for jail in jails}
+        for future in concurrent.futures.as_completed(futures):
+            jail_name = futures[future]
+            results[jail_name] = future.result()
+            if on_done:
+                on_done(jail_name, results[jail_name])
+
+    return results
+
+
+def create_manifest_jails(manifest_path, jobs=1, start_now=False):
+    """
+    Create all jails in a manifest, running at most jobs creates at once.
+    """
+    try:
+        check_script_dir_safe()
+        jails = read_manifest(manifest_path)
+    except JailmakerError as error:
+        eprint(error)
+        return error.returncode
+
+    print(f"Creating {len(jails)} jails from manifest {manifest_path}.")
+
+    start_time = time.monotonic()
+
+    def on_done(jail_name, result):
+        duration = time.monotonic() - start_time
+        if isinstance(result, JailmakerError):
+            eprint(f"Failed to create jail {jail_name} after {duration:.1f}s:")
+            eprint(result)
+        else:
+            print(f"Created jail {jail_name} after {duration:.1f}s.")
+
+    results = create_many(jails, jobs, start_now, on_done)
+
+    print_table(
+        ["name", "result", "returncode"],
+        [
+            {
+                "name": jail_name,
+                "result": "failed" if isinstance(result, JailmakerError) else "created",
+                "returncode": (
+                    result.returncode if isinstance(result, JailmakerError) else 0
+                ),
+            }
+            for jail_name, result in sorted(results.items())
+        ],
+        "-",
+    )
+
+    if any(isinstance(result, JailmakerError) for result in results.values()):
+        return 1
 
     return 0
 
 
+def read_machine_state(machine_name):
+    """
+    Read the state file machined keeps for a registered machine.
+    Returns None if no machine with this name is registered.
+    """
+    state = {}
+    try:
+        with open(os.path.join(MACHINES_STATE_DIR_PATH, machine_name)) as f:
+            for line in f:
+                key, sep, value = line.rstrip("\n").partition("=")
+                if sep:
+                    state[key] = value
+    except (FileNotFoundError, IsADirectoryError):
+        return None
+
+    return state
+
+
+# Snapshot of the running machines kept up to date by the daemon
+_machines_snapshot = None
+
+
+def get_running_machines():
+    """
+    Return a snapshot of the machines registered with machined, indexed by name.
+    """
+    if _machines_snapshot is not None:
+        return dict(_machines_snapshot)
+
+    machines = {}
+    try:
+        machine_names = os.listdir(MACHINES_STATE_DIR_PATH)
+    except FileNotFoundError:
+        # Machined is not running, so there are no machines
+        return machines
+
+    for machine_name in machine_names:
+        # Skip the unit:* symlinks and temporary files in the state dir
+        if ":" in machine_name or machine_name.startswith("."):
+            continue
+
+        if (state := read_machine_state(machine_name)) is not None:
+            machines[machine_name] = state
+
+    return machines
+
+
+def get_machine_addresses(leader):
+    """
+    Return the IP addresses in the network namespace of the process with given pid.
+    Returns an empty list when the process doesn't use private networking.
+    """
+    import ipaddress
+
+    addresses = []
+    try:
+        if (
+            os.stat(f"/proc/{leader}/ns/net").st_ino
+            == os.stat("/proc/self/ns/net").st_ino
+        ):
+            return addresses
+
+        # The local IPv4 addresses are listed as "/32 host LOCAL" in the fib trie
+        with open(f"/proc/{leader}/net/fib_trie") as f:
+            previous_line = ""
+            for line in f:
+                if "/32 host LOCAL" in line:
+                    address = previous_line.split()[-1]
+                    if not address.startswith("127.") and address not in addresses:
+                        addresses.append(address)
+                previous_line = line
+
+        # Format: address ifindex prefix_length scope flags interface
+        with open(f"/proc/{leader}/net/if_inet6") as f:
+            for line in f:
+                fields = line.split()
+                # Skip addresses with host scope (loopback)
+                if fields[3] != "10":
+                    addresses.append(str(ipaddress.IPv6Address(int(fields[0], 16))))
+    except (OSError, IndexError, ValueError):
+        pass
+
+    return addresses
+
+
 def jail_is_running(jail_name):
-    return (
-        subprocess.run(
-            ["machinectl", "show", jail_name],
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL,
-        ).returncode
-        == 0
+    # Machined keeps a state file for each registered machine
+    return os.path.basename(jail_name) == jail_name and os.path.exists(
+        os.path.join(MACHINES_STATE_DIR_PATH, jail_name)
     )
 
 
@@ -1577,24 +3610,312 @@ def edit_jail(jail_name):
     return 0
 
 
+def wait_for_jails(jail_names, running, timeout=None, on_tick=None):
+    """
+    Wait until the jails with given names are running (or stopped when running is False).
+    Calls on_tick about once per second while waiting.
+    Returns the names of the jails which didn't reach the state before the timeout.
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+
+    with MachinesWatch() as watch:
+        # Check the state after the watch has been setup, so no change goes unnoticed
+        pending = [x for x in jail_names if jail_is_running(x) != running]
+
+        while pending:
+            wait_time = 1
+            if deadline is not None:
+                wait_time = min(wait_time, deadline - time.monotonic())
+                if wait_time <= 0:
+                    break
+
+            if watch.wait(wait_time):
+                pending = [x for x in pending if jail_is_running(x) != running]
+            elif on_tick:
+                on_tick()
+
+    return pending
+
+
+def wait_jail(jail_name, state="running", timeout=None):
+    """
+    Wait until jail with given name is in the given state (running or stopped).
+    """
+    if wait_for_jails([jail_name], state == "running", timeout):
+        eprint(f"Timed out waiting for jail {jail_name} to be {state}.")
+        return 1
+
+    return 0
+
+
 def stop_jail(jail_name):
     """
     Stop jail with given name and wait until stopped.
     """
+    return stop_jails([jail_name])
 
-    if not jail_is_running(jail_name):
-        return 0
 
-    returncode = subprocess.run(["machinectl", "poweroff", jail_name]).returncode
-    if returncode != 0:
-        eprint("Error while stopping jail.")
-        return returncode
+def resolve_jail_names(jail_names, all_jails=False):
+    """
+    Expand shell-style wildcards in jail_names (or select all jails) to jail names.
+    """
+    if all_jails:
+        return sorted(get_all_jail_names())
+
+    resolved = []
+    for pattern in jail_names:
+        if not any(char in pattern for char in "*?["):
+            resolved.append(pattern)
+            continue
+
+        matches = sorted(fnmatch.filter(get_all_jail_names(), pattern))
+        if not matches:
+            eprint(f"No jails match {pattern}.")
+        resolved += matches
+
+    # Remove duplicates while preserving order
+    return list(dict.fromkeys(resolved))
+
+
+def get_stop_timeout(jail_name):
+    """
+    Return the stop_timeout from the config of jail with given name (None for no timeout).
+    """
+    config = parse_config_file(get_jail_config_path(jail_name))
+    try:
+        timeout = float(config.my_get("stop_timeout")) if config else 0
+    except ValueError:
+        eprint(f"Invalid stop_timeout in config of jail {jail_name}.")
+        timeout = 0
+
+    return timeout or None
+
+
+_system_bus = None
 
-    print(f"Wait for {jail_name} to stop", end="", flush=True)
 
-    while jail_is_running(jail_name):
-        time.sleep(1)
-        print(".", end="", flush=True)
+def set_systemd_backend(backend):
+    global systemd_backend
+    systemd_backend = backend
+
+
+def get_system_bus():
+    """
+    Return the connection to the system bus when using the dbus backend.
+    Returns None when using the subprocess backend, or if connecting fails.
+    """
+    global _system_bus, systemd_backend
+
+    if systemd_backend != "dbus":
+        return None
+
+    if not _system_bus:
+        try:
+            _system_bus = DBusConnection()
+        except (OSError, DBusError) as error:
+            eprint(f"Unable to connect to D-Bus ({error}), falling back to subprocess.")
+            systemd_backend = "subprocess"
+
+    return _system_bus
+
+
+def call_machined(method, signature, *args):
+    return get_system_bus().call(
+        "org.freedesktop.machine1",
+        "/org/freedesktop/machine1",
+        "org.freedesktop.machine1.Manager",
+        method,
+        signature,
+        args,
+    )
+
+
+def call_systemd(method, signature, *args):
+    return get_system_bus().call(
+        "org.freedesktop.systemd1",
+        "/org/freedesktop/systemd1",
+        "org.freedesktop.systemd1.Manager",
+        method,
+        signature,
+        args,
+    )
+
+
+def poweroff_jails(jail_names):
+    """
+    Request jails with given names to shutdown, without waiting for them to stop.
+    Returns a dict with the return code per jail.
+    """
+    if get_system_bus():
+        returncodes = {}
+        for jail_name in jail_names:
+            try:
+                # Same as machinectl poweroff: send SIGRTMIN+4 to the init system
+                call_machined(
+                    "KillMachine", "ssi", jail_name, "leader", signal.SIGRTMIN + 4
+                )
+                returncodes[jail_name] = 0
+            except DBusError as error:
+                eprint(error.message)
+                returncodes[jail_name] = 1
+        return returncodes
+
+    # Send the poweroff requests concurrently instead of one after another
+    results = run_operations(
+        {jail_name: ["machinectl", "poweroff", jail_name] for jail_name in jail_names},
+        jobs=MAX_JOBS,
+        capture=False,
+    )
+    return {jail_name: results[jail_name].returncode for jail_name in jail_names}
+
+
+def terminate_jail(jail_name):
+    if get_system_bus():
+        with contextlib.suppress(DBusError):
+            call_machined("TerminateMachine", "s", jail_name)
+        return
+
+    subprocess.run(["machinectl", "terminate", jail_name])
+
+
+def kill_jail(jail_name):
+    if get_system_bus():
+        with contextlib.suppress(DBusError):
+            call_systemd(
+                "KillUnit",
+                "ssi",
+                f"{SHORTNAME}-{jail_name}.service",
+                "all",
+                signal.SIGKILL,
+            )
+        return
+
+    subprocess.run(
+        ["systemctl", "kill", "--signal=SIGKILL", f"{SHORTNAME}-{jail_name}"]
+    )
+
+
+def escalate_stop_jail(jail_name, stage, verbose=False):
+    """
+    Forcefully stop jail with given name: terminate it (stage 1) or kill it (stage 2).
+    """
+    if stage == 1:
+        if verbose:
+            eprint(f"\nJail {jail_name} didn't shutdown in time. Terminating...")
+        with trace("terminate", jail=jail_name):
+            terminate_jail(jail_name)
+    else:
+        if verbose:
+            eprint(f"\nJail {jail_name} didn't terminate in time. Killing...")
+        with trace("kill", jail=jail_name):
+            kill_jail(jail_name)
+
+
+def stop(jail_names, timeout=None, verbose=False):
+    """
+    Stop jails with given names, wait until all of them are stopped and return a
+    StopResult for each jail which was running. Raise JailmakerError when a jail failed to stop.
+    Jails which don't shutdown within their timeout are terminated and then killed.
+    Print the progress when verbose.
+    """
+    running_machines = get_running_machines()
+    running = [x for x in jail_names if x in running_machines]
+
+    if not running:
+        return []
+
+    started_at = time.time()
+    start_time = time.monotonic()
+    results = []
+    failed = []
+    returncode = 0
+    stopping = []
+    with trace("poweroff", jails=running):
+        poweroff_returncodes = poweroff_jails(running)
+    for jail_name, poweroff_returncode in poweroff_returncodes.items():
+        if poweroff_returncode != 0:
+            failed.append(jail_name)
+            returncode = poweroff_returncode
+        else:
+            stopping.append(jail_name)
+
+    if verbose and stopping:
+        print(f"Wait for {', '.join(stopping)} to stop", end="", flush=True)
+
+    stages = ["poweroff", "terminate", "SIGKILL"]
+    stage = {jail_name: 0 for jail_name in stopping}
+    deadlines = {}
+    for jail_name in stopping:
+        jail_timeout = get_stop_timeout(jail_name) if timeout is None else timeout
+        if jail_timeout:
+            deadlines[jail_name] = time.monotonic() + jail_timeout
+
+    pending = stopping
+    while pending:
+        pending_deadlines = [deadlines[x] for x in pending if x in deadlines]
+        with trace("wait for stop", jails=pending):
+            still_running = wait_for_jails(
+                pending,
+                running=False,
+                timeout=(
+                    max(0, min(pending_deadlines) - time.monotonic())
+                    if pending_deadlines
+                    else None
+                ),
+                on_tick=(lambda: print(".", end="", flush=True)) if verbose else None,
+            )
+
+        for jail_name in pending:
+            if jail_name not in still_running:
+                result = StopResult(
+                    jail_name, stages[stage[jail_name]], time.monotonic() - start_time
+                )
+                results.append(result)
+                add_history(jail_name, "stop", started_at, result.duration, 0)
+                if verbose:
+                    print(f"\nJail {jail_name} stopped after {result.stage}.")
+
+        pending = []
+        for jail_name in still_running:
+            if deadlines.get(jail_name, math.inf) > time.monotonic():
+                pending.append(jail_name)
+            elif stage[jail_name] == len(stages) - 1:
+                failed.append(jail_name)
+                returncode = 1
+            else:
+                stage[jail_name] += 1
+                escalate_stop_jail(jail_name, stage[jail_name], verbose)
+                deadlines[jail_name] = time.monotonic() + STOP_ESCALATION_TIMEOUT
+                pending.append(jail_name)
+
+    for jail_name in failed:
+        add_history(
+            jail_name, "stop", started_at, time.monotonic() - start_time, returncode
+        )
+
+    if failed:
+        if verbose and stopping:
+            # End the line of progress dots
+            print()
+        raise JailmakerError(f"Failed to stop jail {', '.join(failed)}.", returncode)
+
+    return results
+
+
+def stop_jails(jail_names, all_jails=False, timeout=None):
+    """
+    Stop jails with given names and wait until all of them are stopped.
+    Jails which don't shutdown within their timeout are terminated and then killed.
+    """
+    if not jail_names and not all_jails:
+        eprint("Please provide the names of the jails to stop or pass --all.")
+        return 1
+
+    try:
+        stop(resolve_jail_names(jail_names, all_jails), timeout, verbose=True)
+    except JailmakerError as error:
+        eprint(error)
+        return error.returncode
 
     return 0
 
@@ -1650,18 +3971,6 @@ def print_table(header, list_of_objects, empty_value_indicator):
         print(" ".join(str(obj.get(hdr)).ljust(widths[hdr]) for hdr in header))
 
 
-def run_command_and_parse_json(command):
-    result = subprocess.run(command, capture_output=True, text=True)
-    output = result.stdout.strip()
-
-    try:
-        parsed_output = json.loads(output)
-        return parsed_output
-    except json.JSONDecodeError as e:
-        eprint(f"Error parsing JSON: {e}")
-        return None
-
-
 def get_all_jail_names():
     try:
         jail_names = os.listdir(JAILS_DIR_PATH)
@@ -1672,110 +3981,583 @@ def get_all_jail_names():
 
 
 def parse_os_release(new_root):
-    result = {}
-    with Chroot(new_root):
-        # Use chroot to correctly resolve os-release symlink (for nixos)
-        for candidate in ["/etc/os-release", "/usr/lib/os-release"]:
-            try:
-                with open(candidate, encoding="utf-8") as f:
-                    # TODO: can I create a solution which not depends on the internal _parse_os_release method?
-                    result = platform._parse_os_release(f)
-                    break
-            except OSError:
-                # Silently ignore failing to read os release info
-                pass
+    import platform
+
+    result = {}
+    # Resolve the os-release symlink (for nixos) inside the rootfs
+    for candidate in ["/etc/os-release", "/usr/lib/os-release"]:
+        try:
+            with open(open_in_root(new_root, candidate), encoding="utf-8") as f:
+                # TODO: can I create a solution which not depends on the internal _parse_os_release method?
+                result = platform._parse_os_release(f)
+                break
+        except OSError:
+            # Silently ignore failing to read os release info
+            pass
 
     return result
 
 
-def list_jails():
+def get_running_jails():
+    """
+    Return the machined state of the running jails by name.
+    """
+    # We're only interested in systemd-nspawn machines
+    return {
+        machine_name: machine
+        for machine_name, machine in get_running_machines().items()
+        if machine.get("SERVICE") == "systemd-nspawn"
+    }
+
+
+def get_jail(jail_name, running_jails=None, fields=None):
+    """
+    Return a JailInfo for the jail with given name.
+    Pass the result of get_running_jails to avoid reading it again for each jail.
+    Only the given fields are computed (all by default), the others are None.
+    """
+    fields = set(JailInfo._fields if fields is None else fields)
+    info = dict.fromkeys(JailInfo._fields)
+    info["name"] = jail_name
+
+    if fields & {"running", "addresses"}:
+        if running_jails is None:
+            running_jails = get_running_jails()
+        info["running"] = jail_name in running_jails
+
+    if "addresses" in fields:
+        info["addresses"] = []
+        if jail_name in running_jails:
+            with trace("addresses", jail=jail_name):
+                info["addresses"] = get_machine_addresses(
+                    running_jails[jail_name]["LEADER"]
+                )
+
+    if fields & {"startup", "gpu_intel", "gpu_nvidia"}:
+        with trace("parse config", jail=jail_name):
+            config = parse_config_file(get_jail_config_path(jail_name))
+        if config:
+            info["startup"] = config.my_getboolean("startup")
+            info["gpu_intel"] = config.my_getboolean("gpu_passthrough_intel")
+            info["gpu_nvidia"] = config.my_getboolean("gpu_passthrough_nvidia")
+
+    if fields & {"os", "version"}:
+        # Parse os-release info ourselves
+        with trace("os-release", jail=jail_name):
+            jail_platform = parse_os_release(get_jail_rootfs_path(jail_name))
+        info["os"] = jail_platform.get("ID")
+        info["version"] = jail_platform.get("VERSION_ID") or jail_platform.get(
+            "VERSION_CODENAME"
+        )
+
+    return JailInfo(**info)
+
+
+def iter_jails(fields=None):
+    """
+    Yield a JailInfo for each jail, sorted by name, computing only the given fields.
+    """
+    running_jails = None
+    if fields is None or {"running", "addresses"} & set(fields):
+        with trace("running jails"):
+            running_jails = get_running_jails()
+
+    jail_names = sorted(get_all_jail_names())
+
+    if fields is not None and not {"os", "version", "addresses"} & set(fields):
+        # Nothing to gain from threads when only looking at the config
+        for jail_name in jail_names:
+            yield get_jail(jail_name, running_jails, fields)
+        return
+
+    import concurrent.futures
+
+    # Reading files inside the jails doesn't hold the GIL, so look up jails
+    # in parallel, the results are still yielded in order
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_JOBS) as executor:
+        yield from executor.map(
+            lambda jail_name: get_jail(jail_name, running_jails, fields), jail_names
+        )
+
+
+def get_jails(fields=None):
+    """
+    Return a JailInfo for each jail, sorted by name, computing only the given fields.
+    """
+    return list(iter_jails(fields))
+
+
+def format_jail_field(jail, field):
+    """
+    Return the value of a JailInfo field as shown by the list command.
+    """
+    value = getattr(jail, field)
+    if field == "addresses":
+        if not jail.running:
+            return None
+        # Show the first address inside the running jail
+        if not value:
+            return "-"
+        return value[0] + ("…" if len(value) > 1 else "")
+    return value
+
+
+def list_jails(fields=None, output_format="table"):
     """
     List all available and running jails.
+    Only the given fields are computed and shown.
     """
+    fields = fields or list(JailInfo._fields)
+
+    if output_format == "json":
+        import json
+
+        # Stream one JSON object per line
+        for jail in iter_jails(fields):
+            print(json.dumps({field: getattr(jail, field) for field in fields}))
+
+        return 0
+
+    if output_format == "csv":
+        import csv
 
-    jails = {}
-    empty_value_indicator = "-"
+        writer = csv.writer(sys.stdout)
+        writer.writerow(fields)
+        for jail in iter_jails(fields):
+            writer.writerow(
+                [
+                    (
+                        " ".join(getattr(jail, field))
+                        if field == "addresses"
+                        else getattr(jail, field)
+                    )
+                    for field in fields
+                ]
+            )
+
+        return 0
 
-    jail_names = get_all_jail_names()
+    rows = [
+        {field: format_jail_field(jail, field) for field in fields}
+        for jail in iter_jails(fields)
+    ]
 
-    if not jail_names:
+    if not rows:
         print("No jails.")
         return 0
 
-    # Get running jails from machinectl
-    running_machines = run_command_and_parse_json(["machinectl", "list", "-o", "json"])
-    # Index running_machines by machine name
-    # We're only interested in systemd-nspawn machines
-    running_machines = {
-        item["machine"]: item
-        for item in running_machines
-        if item["service"] == "systemd-nspawn"
+    print_table(fields, rows, "-")
+
+    return 0
+
+
+def get_start_command(jail_name, wait=False):
+    """
+    Return the command to start jail with given name in a separate process.
+    """
+    return [
+        sys.executable,
+        SCRIPT_PATH,
+        "start",
+        jail_name,
+        *(["--wait"] if wait else []),
+    ]
+
+
+def get_startup_layers(jail_names, dependencies):
+    """
+    Sort jails into layers, where each jail only depends on jails in earlier layers.
+    Returns the list of layers and the set of jails which are part of a dependency cycle.
+    """
+    remaining = {
+        jail_name: set(dependencies[jail_name]) & set(jail_names)
+        for jail_name in jail_names
     }
+    layers = []
 
-    for jail_name in jail_names:
-        jail_rootfs_path = get_jail_rootfs_path(jail_name)
-        jails[jail_name] = {"name": jail_name, "running": False}
-        jail = jails[jail_name]
+    while remaining:
+        layer = sorted(jail_name for jail_name, deps in remaining.items() if not deps)
+        if not layer:
+            # Every remaining jail waits for another remaining jail
+            break
+
+        layers.append(layer)
+        for jail_name in layer:
+            del remaining[jail_name]
+        for deps in remaining.values():
+            deps.difference_update(layer)
 
+    return layers, set(remaining)
+
+
+def startup_jails(jobs=1, timeout=None):
+    """
+    Start all jails with startup=1 in their config, running at most jobs starts at once.
+    Jails are started in dependency order, as declared with the after= and requires= keys.
+    Starting a jail is aborted when it takes longer than timeout seconds.
+    """
+    configs = {}
+    for jail_name in get_all_jail_names():
         config = parse_config_file(get_jail_config_path(jail_name))
         if config:
-            jail["startup"] = config.my_getboolean("startup")
-            jail["gpu_intel"] = config.my_getboolean("gpu_passthrough_intel")
-            jail["gpu_nvidia"] = config.my_getboolean("gpu_passthrough_nvidia")
-
-        if jail_name in running_machines:
-            machine = running_machines[jail_name]
-            # Augment the jails dict with output from machinectl
-            jail["running"] = True
-            jail["os"] = machine["os"] or None
-            jail["version"] = machine["version"] or None
-
-            addresses = machine.get("addresses")
-            if not addresses:
-                jail["addresses"] = empty_value_indicator
+            configs[jail_name] = config
+
+    after = {
+        jail_name: set(config.my_get("after").split())
+        for jail_name, config in configs.items()
+    }
+    requires = {
+        jail_name: set(config.my_get("requires").split())
+        for jail_name, config in configs.items()
+    }
+
+    results = {}
+
+    def record(jail_name, returncode, result, duration=None):
+        results[jail_name] = {
+            "name": jail_name,
+            "result": result,
+            "returncode": returncode,
+            "duration": None if duration is None else f"{duration:.1f}s",
+        }
+
+    # Select the jails to start, including the ones they require
+    to_start = [
+        jail_name
+        for jail_name, config in configs.items()
+        if config.my_getboolean("startup")
+    ]
+    selected = set()
+    while to_start:
+        jail_name = to_start.pop()
+        if jail_name in selected:
+            continue
+
+        selected.add(jail_name)
+        for dependency in requires[jail_name]:
+            if dependency not in configs:
+                eprint(
+                    f"Jail {jail_name} requires jail {dependency}, which doesn't exist."
+                )
+                record(dependency, 1, "missing")
             else:
-                addresses = addresses.split("\n")
-                jail["addresses"] = addresses[0]
-                if len(addresses) > 1:
-                    jail["addresses"] += "…"
-        else:
-            # Parse os-release info ourselves
-            jail_platform = parse_os_release(jail_rootfs_path)
-            jail["os"] = jail_platform.get("ID")
-            jail["version"] = jail_platform.get("VERSION_ID") or jail_platform.get(
-                "VERSION_CODENAME"
-            )
+                to_start.append(dependency)
 
-    print_table(
-        [
-            "name",
-            "running",
-            "startup",
-            "gpu_intel",
-            "gpu_nvidia",
-            "os",
-            "version",
-            "addresses",
-        ],
-        sorted(jails.values(), key=lambda x: x["name"]),
-        empty_value_indicator,
+    for jail_name in selected:
+        for dependency in after[jail_name] - set(configs):
+            eprint(f"Ignoring after={dependency} of jail {jail_name}, no such jail.")
+
+    layers, cyclic = get_startup_layers(
+        selected,
+        {jail_name: after[jail_name] | requires[jail_name] for jail_name in selected},
     )
 
+    for jail_name in sorted(cyclic):
+        eprint(f"Skipped starting jail {jail_name}, it's part of a dependency cycle.")
+        record(jail_name, 1, "cycle")
+
+    # Wait until jails other jails depend on have booted before starting the next layer
+    depended_on = set().union(*(after[x] | requires[x] for x in selected))
+
+    running_machines = get_running_machines()
+
+    for layer in layers:
+        layer_jail_names = []
+        for jail_name in layer:
+            failed_requirements = [
+                dependency
+                for dependency in sorted(requires[jail_name])
+                if results.get(dependency, {}).get("returncode")
+            ]
+            if failed_requirements:
+                eprint(
+                    f"Skipped starting jail {jail_name}, "
+                    f"required jail {', '.join(failed_requirements)} failed to start."
+                )
+                record(jail_name, 1, "skipped")
+            elif jail_name in running_machines:
+                eprint(f"Skipped starting jail {jail_name}, it's already running.")
+                record(jail_name, 0, "running")
+            else:
+                layer_jail_names.append(jail_name)
+
+        def on_done(result):
+            if result.returncode is None:
+                eprint(
+                    f"Aborted starting jail {result.name}, it took longer than {timeout:g} seconds."
+                )
+                record(result.name, 1, "timeout", result.duration)
+            else:
+                record(
+                    result.name,
+                    result.returncode,
+                    "started" if result.returncode == 0 else "failed",
+                    result.duration,
+                )
+
+            if result.output is not None:
+                # Print the output of each jail as a whole once it's done starting
+                print(f"{BOLD}==> {result.name}{NORMAL}")
+                print(result.output.rstrip())
+                print()
+
+        # When starting one jail at a time its output can be shown as it happens
+        run_operations(
+            {
+                jail_name: get_start_command(jail_name, jail_name in depended_on)
+                for jail_name in layer_jail_names
+            },
+            jobs,
+            timeout,
+            capture=jobs != 1,
+            on_done=on_done,
+        )
+
+    if jobs != 1 and results:
+        print_table(
+            ["name", "result", "returncode", "duration"],
+            sorted(results.values(), key=lambda x: x["name"]),
+            "-",
+        )
+
+    if any(result["returncode"] != 0 for result in results.values()):
+        return 1
+
     return 0
 
 
-def startup_jails():
-    start_failure = False
+def refresh_daemon_state():
+    """
+    Update the machines snapshot and parsed configs the daemon keeps in memory.
+    """
+    global _machines_snapshot
+
+    _machines_snapshot = None
+    _machines_snapshot = get_running_machines()
+
     for jail_name in get_all_jail_names():
-        config = parse_config_file(get_jail_config_path(jail_name))
-        if config and config.my_getboolean("startup"):
-            if start_jail(jail_name) != 0:
-                start_failure = True
+        jail_config_path = get_jail_config_path(jail_name)
+        if os.path.exists(jail_config_path):
+            parse_config_file(jail_config_path)
+
+
+def send_daemon_message(conn, message, fds=()):
+    import json
+    import socket
+
+    data = json.dumps(message).encode()
+    socket.send_fds(conn, [struct.pack("<I", len(data)) + data], fds)
+
+
+def receive_daemon_message(conn, max_fds=0):
+    """
+    Receive a length prefixed json message and the file descriptors sent along.
+    """
+    import json
+    import socket
+
+    data, fds, _, _ = socket.recv_fds(conn, 65536, max_fds)
+    try:
+        while len(data) < 4 or len(data) < 4 + struct.unpack_from("<I", data)[0]:
+            chunk = conn.recv(65536)
+            if not chunk:
+                raise ConnectionError("Connection closed by peer")
+            data += chunk
+
+        return json.loads(data[4:]), fds
+    except BaseException:
+        for fd in fds:
+            os.close(fd)
+        raise
+
+
+def serve_daemon_request(server, conn):
+    """
+    Run the command requested on the connection in a forked child process.
+    The child takes over the stdin, stdout and stderr of the client.
+    """
+    import socket
+    import traceback
 
-    if start_failure:
+    try:
+        _, uid, _ = struct.unpack(
+            "3i",
+            conn.getsockopt(
+                socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")
+            ),
+        )
+        if uid != 0:
+            return
+
+        request, fds = receive_daemon_message(conn, max_fds=3)
+    except ConnectionError:
+        # Connected only to check if the daemon is running
+        return
+    except (OSError, ValueError) as error:
+        eprint(f"Invalid request: {error}")
+        return
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    if os.fork():
+        for fd in fds:
+            os.close(fd)
+        return
+
+    returncode = 1
+    try:
+        server.close()
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+        for target_fd, fd in enumerate(fds):
+            os.dup2(fd, target_fd)
+            os.close(fd)
+
+        os.chdir(request["cwd"])
+        os.environ.clear()
+        os.environ.update(request["env"])
+        sys.argv = [SCRIPT_PATH, *request["argv"]]
+
+        def interrupt_on_hangup():
+            # The client sends a byte (or disconnects) when interrupted by the user
+            with contextlib.suppress(OSError):
+                conn.recv(1)
+            os.kill(os.getpid(), signal.SIGINT)
+
+        threading.Thread(target=interrupt_on_hangup, daemon=True).start()
+
+        try:
+            main(use_daemon=False)
+            returncode = 0
+        except SystemExit as error:
+            if isinstance(error.code, str):
+                eprint(error.code)
+            returncode = 1 if isinstance(error.code, str) else error.code or 0
+        except KeyboardInterrupt:
+            returncode = 130
+        except BaseException:
+            traceback.print_exc()
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        send_daemon_message(conn, {"returncode": returncode})
+    finally:
+        os._exit(returncode)
+
+
+def run_daemon():
+    """
+    Serve commands over a unix socket, keeping jail state and configs in memory.
+    """
+    import socket
+
+    if daemon_is_running():
+        eprint(f"The {SHORTNAME} daemon is already running.")
         return 1
 
-    return 0
+    os.makedirs(RUNTIME_DIR_PATH, mode=0o700, exist_ok=True)
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(DAEMON_SOCKET_PATH)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # Only root may connect to the socket
+    old_umask = os.umask(0o077)
+    try:
+        server.bind(DAEMON_SOCKET_PATH)
+    finally:
+        os.umask(old_umask)
+    server.listen()
+
+    # Let the kernel reap the children serving the requests
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    print(f"Listening on {DAEMON_SOCKET_PATH}.", flush=True)
+
+    try:
+        with server, MachinesWatch() as watch:
+            refresh_daemon_state()
+            while True:
+                if watch.fd is None:
+                    readable = select.select([server], [], [], 1)[0]
+                else:
+                    readable = select.select([server, watch.fd], [], [])[0]
+
+                # Also picks up changes which arrived while accepting the connection
+                if watch.wait(0):
+                    refresh_daemon_state()
+
+                if server in readable:
+                    conn, _ = server.accept()
+                    with conn:
+                        refresh_daemon_state()
+                        serve_daemon_request(server, conn)
+    finally:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(DAEMON_SOCKET_PATH)
+
+
+def connect_to_daemon():
+    import socket
+
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(DAEMON_SOCKET_PATH)
+    except OSError:
+        conn.close()
+        raise
+
+    return conn
+
+
+def daemon_is_running():
+    try:
+        connect_to_daemon().close()
+        return True
+    except OSError:
+        return False
+
+
+def run_in_daemon(argv):
+    """
+    Run command in the daemon, if it's running and serves this command.
+    Returns the return code, or None if the command should run directly.
+    """
+    command = next((arg for arg in argv if not arg.startswith("-")), None)
+    if command not in DAEMON_COMMANDS or os.getuid() != 0:
+        return None
+
+    if any(item in split_at_string(argv, "--")[0] for item in ["-h", "--help"]):
+        return None
+
+    try:
+        conn = connect_to_daemon()
+    except OSError:
+        return None
+
+    with conn:
+        try:
+            send_daemon_message(
+                conn,
+                {"argv": argv, "cwd": os.getcwd(), "env": dict(os.environ)},
+                [0, 1, 2],
+            )
+        except OSError:
+            return None
+
+        while True:
+            try:
+                response, _ = receive_daemon_message(conn)
+                return response["returncode"]
+            except KeyboardInterrupt:
+                # Let the daemon interrupt the command, and wait for it to finish
+                with contextlib.suppress(OSError):
+                    conn.sendall(b"\0")
+            except (OSError, ValueError, KeyError):
+                eprint(f"Lost connection to the {SHORTNAME} daemon.")
+                return 1
 
 
 def split_at_string(lst, string):
@@ -1786,6 +4568,52 @@ def split_at_string(lst, string):
         return lst, []
 
 
+def field_list(value):
+    """
+    Argparse type for a comma separated list of JailInfo fields.
+    """
+    import argparse
+
+    fields = [field.strip() for field in value.split(",") if field.strip()]
+    for field in fields:
+        if field not in JailInfo._fields:
+            raise argparse.ArgumentTypeError(
+                f"invalid field: '{field}' (choose from {', '.join(JailInfo._fields)})"
+            )
+
+    return fields
+
+
+def distro_release(value):
+    """
+    Argparse type for a distro and release separated by a slash.
+    """
+    import argparse
+
+    distro, _, release = value.partition("/")
+    if not distro or not release:
+        raise argparse.ArgumentTypeError(f"expected DISTRO/RELEASE, got '{value}'")
+
+    return distro, release
+
+
+def positive_int(value):
+    """
+    Argparse type for a strictly positive integer.
+    """
+    import argparse
+
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid int value: '{value}'")
+
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+
+    return number
+
+
 def add_parser(subparser, **kwargs):
     if kwargs.get("add_help") is False:
         # Don't add help if explicitly disabled
@@ -1813,7 +4641,237 @@ def add_parser(subparser, **kwargs):
     return parser
 
 
-def main():
+def find_command_name(argv):
+    """
+    Return the name of the command in argv without parsing it, or None if there is none.
+    """
+    argv = iter(argv)
+    for arg in argv:
+        if arg in ["--backend", "--trace"]:
+            next(argv, None)
+        elif arg == "--":
+            return next(argv, None)
+        elif not arg.startswith("-"):
+            return arg
+
+
+def add_command_arguments(command, parser):
+    """
+    Add the arguments of command to its parser.
+    """
+    if command in [
+        "edit",
+        "exec",
+        "log",
+        "remove",
+        "restart",
+        "start",
+        "status",
+        "wait",
+    ]:
+        parser.add_argument("jail_name", help="name of the jail")
+
+    if command == "exec":
+        parser.add_argument(
+            "cmd",
+            nargs="*",
+            help="command to execute",
+        )
+
+    elif command == "shell":
+        parser.add_argument(
+            "args",
+            nargs="*",
+            help="args to pass to machinectl shell",
+        )
+
+    elif command == "log":
+        parser.add_argument(
+            "args",
+            nargs="*",
+            help="args to pass to journalctl",
+        )
+
+    elif command == "status":
+        parser.add_argument(
+            "args",
+            nargs="*",
+            help="args to pass to systemctl",
+        )
+
+    elif command == "stop":
+        parser.add_argument(
+            "jail_names",
+            nargs="*",
+            metavar="jail_name",
+            help="name of the jail (shell-style wildcards are allowed)",
+        )
+        parser.add_argument(
+            "-a",  #
+            "--all",
+            dest="all_jails",
+            help="stop all jails",
+            action="store_true",
+        )
+        parser.add_argument(
+            "--timeout",
+            type=float,
+            help="seconds to wait before forcefully stopping (overrides stop_timeout, 0 waits indefinitely)",
+        )
+
+    elif command == "wait":
+        parser.add_argument(
+            "--state",
+            choices=["running", "stopped"],
+            default="running",
+            help="state to wait for (default: %(default)s)",
+        )
+        parser.add_argument(
+            "--timeout",
+            type=float,
+            help="give up after this many seconds",
+        )
+
+    elif command == "start":
+        parser.add_argument(
+            "--wait",
+            nargs="?",
+            type=float,
+            const=math.inf,
+            metavar="TIMEOUT",
+            help="wait until the jail has booted (at most TIMEOUT seconds if given)",
+        )
+
+    elif command == "list":
+        parser.add_argument(
+            "--fields",
+            type=field_list,
+            help=f"comma separated fields to show (default: {','.join(JailInfo._fields)})",
+        )
+        parser.add_argument(
+            "--format",
+            dest="output_format",
+            choices=["table", "json", "csv"],
+            default="table",
+            help="output format, json prints one object per line (default: %(default)s)",
+        )
+
+    elif command == "history":
+        parser.add_argument(
+            "jail_name",
+            nargs="?",
+            help="only show the history of this jail",
+        )
+        parser.add_argument(
+            "--operation",
+            choices=["create", "initial_setup", "start", "stop"],
+            help="only show the history of this operation",
+        )
+
+    elif command == "startup":
+        parser.add_argument(
+            "-j",  #
+            "--jobs",
+            type=positive_int,
+            default=1,
+            help=f"number of jails to start concurrently, at most {MAX_JOBS} (default: %(default)s)",
+        )
+        parser.add_argument(
+            "--timeout",
+            type=float,
+            help="give up on starting a jail after this many seconds",
+        )
+
+    elif command == "images":
+        parser.add_argument(
+            "--prefetch",
+            nargs="+",
+            type=distro_release,
+            metavar="DISTRO/RELEASE",
+            help="download images into the image store, to create jails from them offline",
+        )
+
+    elif command == "bake":
+        parser.add_argument("image_name", help="name of the image")
+        parser.add_argument(
+            "-c",  #
+            "--config",
+            required=True,
+            help="path to config file template or - for stdin",
+        )
+
+    elif command == "create":
+        parser.add_argument(
+            "jail_name",  #
+            nargs="?",
+            help="name of the jail",
+        )
+        parser.add_argument("--distro")
+        parser.add_argument("--release")
+        parser.add_argument(
+            "--start",  #
+            help="start jail after create",
+            action="store_true",
+        )
+        parser.add_argument(
+            "--startup",
+            type=int,
+            choices=[0, 1],
+            help=f"start this jail when running: {SCRIPT_NAME} startup",
+        )
+        parser.add_argument(
+            "--seccomp",  #
+            type=int,
+            choices=[0, 1],
+            help="turning off seccomp filtering improves performance at the expense of security",
+        )
+        parser.add_argument(
+            "-c",  #
+            "--config",
+            help="path to config file template or - for stdin",
+        )
+        parser.add_argument(
+            "--manifest",
+            metavar="FILE",
+            help="create all jails in an INI file, with a section per jail (see README)",
+        )
+        parser.add_argument(
+            "-j",  #
+            "--jobs",
+            type=positive_int,
+            default=1,
+            help=f"number of jails from the manifest to create concurrently, at most {MAX_JOBS} (default: %(default)s)",
+        )
+        parser.add_argument(
+            "--from-image",
+            metavar="IMAGE",
+            help=f"copy the rootfs and config of an image made with: {SCRIPT_NAME} bake",
+        )
+        parser.add_argument(
+            "-gi",  #
+            "--gpu_passthrough_intel",
+            type=int,
+            choices=[0, 1],
+        )
+        parser.add_argument(
+            "-gn",  #
+            "--gpu_passthrough_nvidia",
+            type=int,
+            choices=[0, 1],
+        )
+        parser.add_argument(
+            "systemd_nspawn_user_args",
+            nargs="*",
+            help="add additional systemd-nspawn flags",
+        )
+
+
+def main(use_daemon=True):
+    import argparse
+
+    if use_daemon and (returncode := run_in_daemon(sys.argv[1:])) is not None:
+        sys.exit(returncode)
+
     if os.stat(SCRIPT_PATH).st_uid != 0:
         fail(
             f"This script should be owned by the root user... Fix it manually with: `chown root {SCRIPT_PATH}`."
@@ -1824,23 +4882,50 @@ def main():
     )
 
     parser.add_argument("--version", action="version", version=__version__)
+    parser.add_argument(
+        "--backend",
+        choices=SYSTEMD_BACKENDS,
+        default=systemd_backend,
+        help="talk to systemd and machined with their CLI tools or over D-Bus",
+    )
+    parser.add_argument(
+        "--trace",
+        metavar="FILE",
+        help="write the duration of each phase and process to FILE (Chrome trace event JSON)",
+    )
 
     subparsers = parser.add_subparsers(
-        title="commands", dest="command", metavar="", parser_class=CustomSubParser
+        title="commands",
+        dest="command",
+        metavar="",
+        parser_class=get_custom_sub_parser_class(),
     )
 
     split_commands = ["create", "exec", "log", "status"]
     commands = {}
+    selected_command = find_command_name(sys.argv[1:])
+    # Looking up the editor is only worth it when listing the commands
+    editor = "a" if selected_command else get_text_editor()
 
     for d in [
+        dict(
+            name="bake",
+            help="run the initial_setup of a config template into an image",
+            func=bake_image,
+        ),
         dict(
             name="create",  #
             help="create a new jail",
             func=create_jail,
         ),
+        dict(
+            name="daemon",
+            help="serve commands from a resident process to speed them up",
+            func=run_daemon,
+        ),
         dict(
             name="edit",
-            help=f"edit jail config with {get_text_editor()} text editor",
+            help=f"edit jail config with {editor} text editor",
             func=edit_jail,
         ),
         dict(
@@ -1848,10 +4933,15 @@ def main():
             help="execute a command in the jail",
             func=exec_jail,
         ),
+        dict(
+            name="history",
+            help="show how long operations on jails took",
+            func=show_history,
+        ),
         dict(
             name="images",
             help="list available images to create jails from",
-            func=run_lxc_download_script,
+            func=list_images,
         ),
         dict(
             name="list",  #
@@ -1896,85 +4986,21 @@ def main():
         ),
         dict(
             name="stop",  #
-            help="stop a running jail",
-            func=stop_jail,
+            help="stop running jails",
+            func=stop_jails,
+        ),
+        dict(
+            name="wait",
+            help="wait until a jail is running or stopped",
+            func=wait_jail,
         ),
     ]:
         commands[d["name"]] = add_parser(subparsers, **d)
 
-    for cmd in ["edit", "exec", "log", "remove", "restart", "start", "status", "stop"]:
-        commands[cmd].add_argument("jail_name", help="name of the jail")
-
-    commands["exec"].add_argument(
-        "cmd",
-        nargs="*",
-        help="command to execute",
-    )
-
-    commands["shell"].add_argument(
-        "args",
-        nargs="*",
-        help="args to pass to machinectl shell",
-    )
-
-    commands["log"].add_argument(
-        "args",
-        nargs="*",
-        help="args to pass to journalctl",
-    )
-
-    commands["status"].add_argument(
-        "args",
-        nargs="*",
-        help="args to pass to systemctl",
-    )
-
-    commands["create"].add_argument(
-        "jail_name",  #
-        nargs="?",
-        help="name of the jail",
-    )
-    commands["create"].add_argument("--distro")
-    commands["create"].add_argument("--release")
-    commands["create"].add_argument(
-        "--start",  #
-        help="start jail after create",
-        action="store_true",
-    )
-    commands["create"].add_argument(
-        "--startup",
-        type=int,
-        choices=[0, 1],
-        help=f"start this jail when running: {SCRIPT_NAME} startup",
-    )
-    commands["create"].add_argument(
-        "--seccomp",  #
-        type=int,
-        choices=[0, 1],
-        help="turning off seccomp filtering improves performance at the expense of security",
-    )
-    commands["create"].add_argument(
-        "-c",  #
-        "--config",
-        help="path to config file template or - for stdin",
-    )
-    commands["create"].add_argument(
-        "-gi",  #
-        "--gpu_passthrough_intel",
-        type=int,
-        choices=[0, 1],
-    )
-    commands["create"].add_argument(
-        "-gn",  #
-        "--gpu_passthrough_nvidia",
-        type=int,
-        choices=[0, 1],
-    )
-    commands["create"].add_argument(
-        "systemd_nspawn_user_args",
-        nargs="*",
-        help="add additional systemd-nspawn flags",
-    )
+    # Only the selected command needs its arguments, building the parsers
+    # of all other commands would only slow down startup
+    if selected_command in commands:
+        add_command_arguments(selected_command, commands[selected_command])
 
     if os.getuid() != 0:
         parser.print_help()
@@ -2025,6 +5051,9 @@ def main():
     # such as args intended to pass through to systemd-run
     args = vars(parser.parse_known_args()[0])
     command = args.pop("command", None)
+    set_systemd_backend(args.pop("backend"))
+    if trace_path := args.pop("trace"):
+        start_tracing(trace_path)
 
     # Start over with original args
     args_to_parse = sys.argv[1:]
@@ -2043,7 +5072,10 @@ def main():
     elif command == "shell":
         # Pass anything after the "shell" command to machinectl
         _, shell_args = split_at_string(args_to_parse, command)
-        sys.exit(args["func"](shell_args))
+        try:
+            sys.exit(args["func"](shell_args))
+        finally:
+            write_trace()
     elif command in split_commands and args["jail_name"]:
         jlmkr_args, remaining_args = split_at_string(args_to_parse, args["jail_name"])
         if remaining_args and remaining_args[0] != "--":
@@ -2056,8 +5088,17 @@ def main():
     # Clean the args
     args.pop("help")
     args.pop("command", None)
+    args.pop("backend")
+    args.pop("trace")
     func = args.pop("func")
-    sys.exit(func(**args))
+    try:
+        with trace(command):
+            sys.exit(func(**args))
+    except JailmakerError as error:
+        eprint(error)
+        sys.exit(error.returncode)
+    finally:
+        write_trace()
 
 
 if __name__ == "__main__":